@@ -4,6 +4,8 @@ import shutil
 import sys
 import zipfile
 
+from core import dbbackup
+
 
 tmpdir = 'backup_tmp'
 posterpath = os.path.join('static', 'images', 'posters')
@@ -44,7 +46,10 @@ def backup(require_confirm=True):
 
     if database:
         print 'Copying database.'
-        shutil.copy2('watcher.sqlite', tmpdir)
+        if not dbbackup.Backup().copy('watcher.sqlite', os.path.join(tmpdir, 'watcher.sqlite')):
+            print 'Unable to copy database.'
+            shutil.rmtree(tmpdir)
+            return
 
     if config:
         print 'Copying config.'
@@ -102,8 +107,10 @@ def restore(require_confirm=True):
     if 'watcher.sqlite' in files:
         print 'Restoring database.'
         src = os.path.join(tmpdir, 'watcher.sqlite')
-        if os.path.isfile('watcher.sqlite'):
-            os.remove('watcher.sqlite')
+        # a WAL left by an unclean shutdown would be replayed onto the restored database
+        for i in ('watcher.sqlite', 'watcher.sqlite-wal', 'watcher.sqlite-shm'):
+            if os.path.isfile(i):
+                os.remove(i)
         shutil.copy(src, cwd)
 
     if 'config.cfg' in files:
@@ -31,10 +31,6 @@ CONFIG = None
 # A list of notification data
 NOTIFICATIONS = []
 
-# Rate limiting
-TMDB_TOKENS = 35
-TMDB_LAST_FILL = None
-
 # Global Media Constants
 RESOLUTIONS = ['BluRay-4K', 'BluRay-1080P', 'BluRay-720P',
                'WebDL-4K', 'WebDL-1080P', 'WebDL-720P',
@@ -89,17 +89,18 @@ class Ajax(object):
         Returns str json.dumps(dict) of status and message
         '''
 
-        def thread_search_grab(data):
-            imdbid = data['imdbid']
-            title = data['title']
-            year = data['year']
-            quality = data['quality']
-            self.predb.check_one(data)
-            if core.CONFIG['Search']['searchafteradd']:
-                if self.searcher.search(imdbid, title, year, quality):
-                    # if we don't need to wait to grab the movie do it now.
-                    if core.CONFIG['Search']['autograb']:
-                        self.snatcher.auto_grab(data)
+        return self.add_movie(data)
+
+    def add_movie(self, data, search=True):
+        ''' Adds movie to Wanted list.
+        :param data: str json.dumps(dict) of info to add to database.
+        :param search: bool start search after add in a new thread <optional - default True>
+
+        See add_wanted_movie. Callers adding many movies at once should pass
+            search=False and then search them with self.search_added().
+
+        Returns str json.dumps(dict) of status and message
+        '''
 
         response = {}
         data = json.loads(data)
@@ -132,8 +133,8 @@ class Ajax(object):
             t2 = threading.Thread(target=self.poster.save_poster, args=(movie['imdbid'], poster_url))
             t2.start()
 
-            if movie['status'] != 'Disabled':  # disable immediately grabbing new release for imports
-                t = threading.Thread(target=thread_search_grab, args=(movie,))
+            if search and movie['status'] != 'Disabled':  # disable immediately grabbing new release for imports
+                t = threading.Thread(target=self.search_grab, args=(movie,))
                 t.start()
 
             response['response'] = True
@@ -146,6 +147,47 @@ class Ajax(object):
             response['error'] = u'Could not write to database. Check logs for more information.'
             return json.dumps(response)
 
+    def search_grab(self, data):
+        ''' Runs search after add for a movie
+        :param data: dict of movie
+
+        Checks predb. If Search on Add is enabled searches for the movie and,
+            if Auto Grab is enabled, snatches the best result.
+
+        Does not return
+        '''
+
+        imdbid = data['imdbid']
+        title = data['title']
+        year = data['year']
+        quality = data['quality']
+        self.predb.check_one(data)
+        if core.CONFIG['Search']['searchafteradd']:
+            if self.searcher.search(imdbid, title, year, quality):
+                # if we don't need to wait to grab the movie do it now.
+                if core.CONFIG['Search']['autograb']:
+                    self.snatcher.auto_grab(data)
+        return
+
+    def search_added(self, imdbids):
+        ''' Runs search after add for many new movies
+        :param imdbids: list of str imdb ids of movies added with add_movie(search=False)
+
+        Movies are searched Network.backlogworkers at a time in a background
+            thread, see Searcher.backlog_search.
+
+        Does not return
+        '''
+
+        movies = [self.sql.get_movie_details('imdbid', i) for i in imdbids]
+        movies = [i for i in movies if i and i['status'] != 'Disabled']
+        if not movies:
+            return
+
+        t = threading.Thread(target=self.searcher.backlog_search, args=(movies,), kwargs={'search': self.search_grab})
+        t.start()
+        return
+
     @cherrypy.expose
     def add_wanted_imdbid(self, imdbid, quality='Default'):
         ''' Method to quckly add movie with just imdbid
@@ -343,13 +385,15 @@ class Ajax(object):
         return json.dumps(response)
 
     @cherrypy.expose
-    def refresh_list(self, list, imdbid='', quality=''):
+    def refresh_list(self, list, imdbid='', quality='', offset=0):
         ''' Re-renders html for Movies/Results list
         :param list: str the html list id to be re-rendered
         :param imdbid: str imdb identification number (tt123456) <optional>
+        :param offset: int number of search results already shown in #result_list <optional>
 
         Calls template file to re-render a list when modified in the database.
-        #result_list requires imdbid.
+        #result_list requires imdbid. With an offset only the next page of
+            #result_list is rendered.
 
         Returns str html content.
         '''
@@ -357,7 +401,8 @@ class Ajax(object):
         if list == u'#movie_list':
             return status.Status.movie_list()
         if list == u'#result_list':
-            return movie_status_popup.MovieStatusPopup().result_list(imdbid, quality)
+            popup = movie_status_popup.MovieStatusPopup()
+            return popup.result_list(imdbid, quality, offset=offset)
 
     @cherrypy.expose
     def test_downloader_connection(self, mode, data):
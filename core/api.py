@@ -4,10 +4,12 @@ import threading
 
 import core
 from core import ajax, sqldb, poster
+from core.helpers import CircuitBreaker
+from core.providers.base import SearchCache
 
 logging = logging.getLogger(__name__)
 
-api_version = 2.0
+api_version = 2.3
 
 ''' API
 
@@ -48,6 +50,26 @@ mode=get_config
 mode=version
     output: {'version': '4fcdda1df1a4ff327c3219311578d703a288e598', 'api_version': 1.0}
 
+mode=querystats
+    input: reset=true           <optional>
+    output: {'since': '2017-03-01 12:00:00', 'histogram': ['<1ms', '<5ms', ...], 'queries': [{'query': 'SELECT ...', 'count': 12, 'total_ms': 8.1, 'mean_ms': 0.68, 'max_ms': 2.3, 'rows': 0, 'locked': 0, 'errors': 0, 'histogram': [10, 2, ...]}]}
+
+    Database statistics for each statement since start or last reset, slowest total time first.
+    If reset is true statistics are cleared after being returned.
+
+mode=searchcache
+    input: reset=true           <optional>
+    output: {'entries': 12, 'hits': 30, 'misses': 45, 'hit_rate': 0.4}
+
+    Indexer search response cache statistics since start or last reset.
+    If reset is true the cache is emptied and statistics are cleared after being returned.
+
+mode=indexerhealth
+    output: {'indexers': [{'indexer': 'https://api.indexer.com/', 'state': 'open', 'failures': 4, 'retry': '2017-03-01 12:04:00', 'last_error': '<urlopen error timed out>', 'last_success': '2017-03-01 11:00:00'}]}
+
+    Health of every indexer contacted since start. NewzNab and TorzNab indexers are listed by url base, other hosts by host name.
+    Searches skip indexers whose state is 'open' until retry.
+
 
 # API Version
 Methods added to the api will increase the version by X.1
@@ -62,6 +84,9 @@ Major version changes can be expected to break api interactions
 1.1     Consistency in responses
 
 2.0     Change to semantically correct json. Responses are now bools instead of str 'true'/'false'
+2.1     Add querystats method
+2.2     Add searchcache method
+2.3     Add indexerhealth method
 
 '''
 
@@ -131,6 +156,15 @@ class API(object):
         elif params['mode'] == u'get_config':
             return json.dumps(core.CONFIG, sort_keys=True, indent=4)
 
+        elif params['mode'] == u'querystats':
+            return self.querystats(reset=params.get('reset') == u'true')
+
+        elif params['mode'] == u'searchcache':
+            return self.searchcache(reset=params.get('reset') == u'true')
+
+        elif params['mode'] == u'indexerhealth':
+            return self.indexerhealth()
+
         else:
             return json.dumps({'response': False,
                                'error': 'invalid mode'})
@@ -204,6 +238,50 @@ class API(object):
 
         return json.dumps(response, indent=1)
 
+    def querystats(self, reset=False):
+        ''' Returns database query statistics
+        :param reset: bool clear statistics after reading <optional>
+
+        Returns str json.dumps(dict)
+        '''
+
+        logging.info(u'API request query statistics.')
+
+        response = {'response': True}
+        response.update(self.sql.get_query_stats())
+
+        if reset:
+            self.sql.reset_query_stats()
+
+        return json.dumps(response, indent=1)
+
+    def searchcache(self, reset=False):
+        ''' Returns indexer search cache statistics
+        :param reset: bool empty cache and clear statistics after reading <optional>
+
+        Returns str json.dumps(dict)
+        '''
+
+        logging.info(u'API request search cache statistics.')
+
+        response = {'response': True}
+        response.update(SearchCache.stats())
+
+        if reset:
+            SearchCache.clear()
+
+        return json.dumps(response, indent=1)
+
+    def indexerhealth(self):
+        ''' Returns health of indexers
+
+        Returns str json.dumps(dict)
+        '''
+
+        logging.info(u'API request indexer health.')
+
+        return json.dumps({'response': True, 'indexers': CircuitBreaker.status()}, indent=1)
+
     def version(self):
         ''' Simple endpoint to return commit hash
 
@@ -0,0 +1,311 @@
+import ctypes
+import datetime
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+import core
+
+logging = logging.getLogger(__name__)
+
+
+class _SQLite(object):
+    ''' ctypes bindings for the sqlite3 online backup API
+
+    Python 2's sqlite3 module does not expose sqlite3_backup_*, so these
+        call the library directly. Only the handful of functions needed to
+        copy one database into another are bound.
+    '''
+
+    OK = 0
+    BUSY = 5
+    LOCKED = 6
+    DONE = 101
+
+    OPEN_READONLY = 0x01
+    OPEN_READWRITE = 0x02
+    OPEN_CREATE = 0x04
+
+    lib = None
+
+    @staticmethod
+    def load():
+        ''' Loads sqlite3 library
+
+        Only the library already used by the sqlite3 module is loaded. Loading
+            a second copy of sqlite in the same process breaks its file locking,
+            so if the sqlite3 module's library cannot be found Backup falls back
+            to VACUUM INTO.
+
+        Returns ctypes.CDLL or None if unavailable
+        '''
+
+        if _SQLite.lib is not None:
+            return _SQLite.lib or None
+
+        paths = []
+        try:
+            import _sqlite3
+            paths.append(_sqlite3.__file__)
+            paths.append(os.path.join(os.path.dirname(_sqlite3.__file__), 'sqlite3.dll'))
+        except Exception, e: # noqa
+            pass
+
+        for path in paths:
+            if not path:
+                continue
+            try:
+                lib = ctypes.CDLL(path)
+                lib.sqlite3_backup_init
+                lib.sqlite3_libversion.restype = ctypes.c_char_p
+            except (OSError, AttributeError):
+                continue
+
+            if lib.sqlite3_libversion() != sqlite3.sqlite_version:
+                logging.debug(u'{} is sqlite {}, not the sqlite3 module\'s {}.'.format(path, lib.sqlite3_libversion(), sqlite3.sqlite_version))
+                continue
+
+            lib.sqlite3_open_v2.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int, ctypes.c_char_p]
+            lib.sqlite3_open_v2.restype = ctypes.c_int
+            lib.sqlite3_close.argtypes = [ctypes.c_void_p]
+            lib.sqlite3_close.restype = ctypes.c_int
+            lib.sqlite3_busy_timeout.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            lib.sqlite3_busy_timeout.restype = ctypes.c_int
+            lib.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+            lib.sqlite3_errmsg.restype = ctypes.c_char_p
+            lib.sqlite3_backup_init.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+            lib.sqlite3_backup_init.restype = ctypes.c_void_p
+            lib.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            lib.sqlite3_backup_step.restype = ctypes.c_int
+            lib.sqlite3_backup_remaining.argtypes = [ctypes.c_void_p]
+            lib.sqlite3_backup_remaining.restype = ctypes.c_int
+            lib.sqlite3_backup_pagecount.argtypes = [ctypes.c_void_p]
+            lib.sqlite3_backup_pagecount.restype = ctypes.c_int
+            lib.sqlite3_backup_finish.argtypes = [ctypes.c_void_p]
+            lib.sqlite3_backup_finish.restype = ctypes.c_int
+
+            logging.debug(u'Loaded sqlite3 backup API from {}.'.format(path))
+            _SQLite.lib = lib
+            return lib
+
+        logging.debug(u'sqlite3 backup API not available.')
+        _SQLite.lib = False
+        return None
+
+
+class Backup(object):
+    ''' Online database backups
+
+    Copies the live database with sqlite's backup API, which reads a
+        consistent snapshot a few pages at a time. Readers and writers are only
+        locked out for the length of one step, and the copy sleeps between
+        steps so the server stays responsive.
+
+    Snapshots are gzipped and stored as <database>.<YYYYmmdd-HHMMSS>.gz. Only
+        the newest Database.backupkeep snapshots are kept. Labelled snapshots,
+        stored as <database>.<label>-<YYYYmmdd-HHMMSS>.gz, are never rotated.
+    '''
+
+    def __init__(self):
+        self.backup_dir = os.path.join(core.PROG_PATH or u'', 'db')
+
+        # backup.py runs without Watcher's config loaded, so fall back to defaults
+        conf = (core.CONFIG or {}).get('Database', {})
+        self.keep = conf.get('backupkeep', 7)
+        self.pages = conf.get('backuppages', 100)
+        self.sleep = conf.get('backupsleep', 0.25)
+        self.timeout = conf.get('busytimeout', 30)
+        return
+
+    def snapshot(self, db_file=None, keep=None, label=None):
+        ''' Writes compressed snapshot of database to self.backup_dir
+        db_file: str path to database <default core.DB_FILE>
+        keep: int number of snapshots to keep <default self.keep>
+        label: str to add to file name, excludes snapshot from rotation <optional>
+
+        Returns str path to snapshot or False on failure
+        '''
+
+        db_file = db_file or core.DB_FILE
+        if keep is None:
+            keep = self.keep
+
+        if not os.path.isfile(db_file):
+            logging.warning(u'Database {} not found, skipping backup.'.format(db_file))
+            return False
+
+        if not os.path.isdir(self.backup_dir):
+            os.mkdir(self.backup_dir)
+
+        name = os.path.basename(db_file)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        if label:
+            stamp = u'{}-{}'.format(label, stamp)
+        tmp = os.path.join(self.backup_dir, u'{}.{}.tmp'.format(name, stamp))
+        snapshot = os.path.join(self.backup_dir, u'{}.{}.gz'.format(name, stamp))
+
+        logging.info(u'Backing up database to {}.'.format(snapshot))
+        start = time.time()
+        try:
+            if not self.copy(db_file, tmp):
+                return False
+
+            with open(tmp, 'rb') as f_in:
+                with gzip.open(snapshot, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        except Exception, e: # noqa
+            logging.error(u'Unable to back up database.', exc_info=True)
+            if os.path.isfile(snapshot):
+                os.remove(snapshot)
+            return False
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+        logging.info(u'Database backup finished in {:.2f} seconds, {} KB.'.format(time.time() - start, os.path.getsize(snapshot) / 1024))
+
+        self.rotate(name, keep)
+        return snapshot
+
+    def copy(self, db_file, dest):
+        ''' Copies database to dest while it is in use
+        db_file: str path to source database
+        dest: str path to write copy to
+
+        Uses the backup API if the sqlite library can be loaded. Otherwise falls
+            back to VACUUM INTO, which also writes a consistent copy but in one
+            step. Without either the database cannot be copied safely while live.
+
+        Returns Bool
+        '''
+
+        if _SQLite.load():
+            return self._copy_paged(db_file, dest)
+        elif sqlite3.sqlite_version_info >= (3, 27, 0):
+            return self._copy_vacuum(db_file, dest)
+        else:
+            logging.error(u'sqlite {} has neither the backup API nor VACUUM INTO, cannot back up live database.'.format(sqlite3.sqlite_version))
+            return False
+
+    def _copy_paged(self, db_file, dest):
+        ''' Copies database with the sqlite3_backup_* API
+        db_file: str path to source database
+        dest: str path to write copy to
+
+        Copies self.pages pages per step, sleeping self.sleep seconds between steps.
+
+        If another connection writes to the database the copy restarts from
+            the first page. After three restarts the rest is copied in a single
+            step so a busy database still gets backed up.
+
+        Returns Bool
+        '''
+
+        lib = _SQLite.load()
+
+        src = ctypes.c_void_p()
+        dst = ctypes.c_void_p()
+        try:
+            # opened read/write so a WAL database's -shm file can be created if missing. Nothing is written.
+            if lib.sqlite3_open_v2(self._path(db_file), ctypes.byref(src), _SQLite.OPEN_READWRITE, None) != _SQLite.OK:
+                logging.error(u'Unable to open {} for backup: {}.'.format(db_file, lib.sqlite3_errmsg(src)))
+                return False
+            if lib.sqlite3_open_v2(self._path(dest), ctypes.byref(dst), _SQLite.OPEN_READWRITE | _SQLite.OPEN_CREATE, None) != _SQLite.OK:
+                logging.error(u'Unable to open {} for backup: {}.'.format(dest, lib.sqlite3_errmsg(dst)))
+                return False
+            lib.sqlite3_busy_timeout(src, int(self.timeout * 1000))
+
+            backup = lib.sqlite3_backup_init(dst, 'main', src, 'main')
+            if not backup:
+                logging.error(u'Unable to start backup: {}.'.format(lib.sqlite3_errmsg(dst)))
+                return False
+
+            restarts = 0
+            remaining = None
+            while True:
+                rc = lib.sqlite3_backup_step(backup, self.pages if restarts < 3 else -1)
+                if rc == _SQLite.DONE:
+                    break
+                elif rc not in (_SQLite.OK, _SQLite.BUSY, _SQLite.LOCKED):
+                    logging.error(u'Database backup failed: {}.'.format(lib.sqlite3_errmsg(dst)))
+                    lib.sqlite3_backup_finish(backup)
+                    return False
+
+                left = lib.sqlite3_backup_remaining(backup)
+                if remaining is not None and left > remaining:
+                    restarts += 1
+                    logging.debug(u'Database changed during backup, restarting copy.')
+                remaining = left
+                logging.debug(u'Database backup {} of {} pages remaining.'.format(left, lib.sqlite3_backup_pagecount(backup)))
+                time.sleep(self.sleep)
+
+            if lib.sqlite3_backup_finish(backup) != _SQLite.OK:
+                logging.error(u'Database backup failed: {}.'.format(lib.sqlite3_errmsg(dst)))
+                return False
+            return True
+        finally:
+            if dst:
+                lib.sqlite3_close(dst)
+            if src:
+                lib.sqlite3_close(src)
+
+    def _path(self, path):
+        ''' Encodes path for sqlite3_open_v2
+        path: str or unicode file path
+
+        Returns str utf-8 encoded path
+        '''
+
+        if isinstance(path, unicode):
+            return path.encode('utf-8')
+        return path
+
+    def _copy_vacuum(self, db_file, dest):
+        ''' Copies database with VACUUM INTO
+        db_file: str path to source database
+        dest: str path to write copy to
+
+        Returns Bool
+        '''
+
+        logging.info(u'sqlite backup API not available, using VACUUM INTO.')
+        if os.path.isfile(dest):
+            os.remove(dest)
+
+        connection = sqlite3.connect(db_file, timeout=self.timeout)
+        try:
+            connection.execute('VACUUM INTO ?', (dest,))
+            return True
+        except Exception, e: # noqa
+            logging.error(u'Unable to back up database.', exc_info=True)
+            return False
+        finally:
+            connection.close()
+
+    def rotate(self, name, keep):
+        ''' Removes old snapshots
+        name: str file name of database
+        keep: int number of snapshots to keep, 0 keeps all
+
+        Only unlabelled snapshots are removed.
+
+        Does not return
+        '''
+
+        if keep < 1:
+            return
+
+        pattern = re.compile(re.escape(name) + r'\.\d{8}-\d{6}\.gz$')
+        snapshots = sorted(i for i in os.listdir(self.backup_dir) if pattern.match(i))
+
+        for i in snapshots[:-keep]:
+            logging.info(u'Removing old database backup {}.'.format(i))
+            try:
+                os.remove(os.path.join(self.backup_dir, i))
+            except Exception, e: # noqa
+                logging.warning(u'Unable to remove old database backup {}.'.format(i), exc_info=True)
+        return
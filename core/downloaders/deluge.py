@@ -1,12 +1,12 @@
 import logging
 import json
-import urllib2
 import zlib
 
 from lib.deluge_client import DelugeRPCClient
 
 import core
 from core.helpers import Torrent, Url
+from core.proxy import Proxy
 
 logging = logging.getLogger(__name__)
 
@@ -261,7 +261,8 @@ class DelugeWeb(object):
         request = Url.request(url, post_data, headers=DelugeWeb.headers)
 
         try:
-            response = urllib2.urlopen(request)
+            # Url.open only returns the body, use its opener to get the cookie
+            response = Proxy.direct_opener.open(request, timeout=30)
             DelugeWeb.cookie = response.headers.get('Set-Cookie')
 
             if DelugeWeb.cookie is None:
@@ -2,6 +2,7 @@ import logging
 from xmlrpclib import ServerProxy
 
 import core
+from core.helpers import UrlTransport
 
 logging = logging.getLogger(__name__)
 
@@ -26,10 +27,10 @@ class Nzbget():
         https = False
         if https:
             url = u"https://{}:{}/{}:{}/xmlrpc".format(host, port, user, passw)
-            nzbg_server = ServerProxy(url)
+            nzbg_server = ServerProxy(url, transport=UrlTransport(https))
         else:
             url = u"http://{}:{}/{}:{}/xmlrpc".format(host, port, user, passw)
-            nzbg_server = ServerProxy(url)
+            nzbg_server = ServerProxy(url, transport=UrlTransport(https))
 
         try:
             nzbg_server.version()
@@ -61,7 +62,7 @@ class Nzbget():
         else:
             url = u"http://{}:{}/{}:{}/xmlrpc".format(host, port, user, passw)
 
-        nzbg_server = ServerProxy(url)
+        nzbg_server = ServerProxy(url, transport=UrlTransport(https))
 
         filename = u'{}.nzb'.format(data['title'])
         contenturl = data['guid']
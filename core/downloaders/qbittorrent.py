@@ -5,6 +5,7 @@ import urllib2
 
 import core
 from core.helpers import Torrent, Url
+from core.proxy import Proxy
 
 logging = logging.getLogger(__name__)
 
@@ -122,7 +123,8 @@ class QBittorrent(object):
         request = Url.request(url, post_data=post_data)
 
         try:
-            response = urllib2.urlopen(request)
+            # Url.open only returns the body, use its opener to get the cookie
+            response = Proxy.direct_opener.open(request, timeout=30)
             QBittorrent.cookie = response.headers.get('Set-Cookie')
             result = response.read()
             response.close()
@@ -1,12 +1,279 @@
 from base64 import b32decode as bd
 from random import choice as rc
+import datetime
 import hashlib
+import httplib
+import logging
+import socket
+import threading
+import time
 import urllib2
+import urlparse
 import random
 import unicodedata
+import xmlrpclib
+import core
+from core.proxy import Proxy
 from lib import bencode
 from string import punctuation
 
+logging = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    ''' Per-host token bucket rate limiter
+
+    Every host gets a bucket that holds up to burst tokens and refills at rate
+        tokens per second. Each request takes one token, waiting for the
+        bucket to refill if it is empty.
+
+    Limits are read from Network.ratelimits as {host: [rate, burst]}. Hosts
+        not listed use the 'default' entry. A rate of 0 disables limiting for
+        that host.
+
+    Waiting threads sleep on the bucket's condition variable until the next
+        token is due. A thread that takes a token and leaves more behind wakes
+        the next waiter so bursts are not serialized.
+    '''
+
+    # {host: RateLimiter}
+    buckets = {}
+    buckets_lock = threading.Lock()
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.condition = threading.Condition()
+        return
+
+    @staticmethod
+    def limits(host):
+        ''' Gets configured limits for host
+        host: str host name
+
+        Returns tuple (float rate per second, float burst)
+        '''
+
+        if not core.CONFIG:
+            return (0, 0)
+        limits = core.CONFIG['Network']['ratelimits']
+        rate, burst = limits.get(host, limits.get('default', [0, 0]))
+        return (rate, burst)
+
+    @staticmethod
+    def acquire(url):
+        ''' Waits until a request to url's host may be sent
+        url: str url of request
+
+        Does not return
+        '''
+
+        host = (urlparse.urlsplit(url).hostname or u'').lower()
+        rate, burst = RateLimiter.limits(host)
+        if rate <= 0:
+            return
+
+        with RateLimiter.buckets_lock:
+            bucket = RateLimiter.buckets.get(host)
+            if bucket is None or (bucket.rate, bucket.burst) != (float(rate), max(float(burst), 1.0)):
+                bucket = RateLimiter.buckets[host] = RateLimiter(rate, burst)
+
+        bucket.take()
+        return
+
+    def take(self):
+        ''' Takes one token, waiting for it if the bucket is empty
+
+        Does not return
+        '''
+
+        with self.condition:
+            while True:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    if self.tokens >= 1:
+                        self.condition.notify()
+                    return
+
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker(object):
+    ''' Tracks health of indexers and other remote hosts
+
+    Each NewzNab and TorzNab indexer has its own circuit, keyed by its url
+        base, so indexers sharing a host (ie behind Jackett or NZBHydra)
+        fail independently. Requests to any other url use a circuit for
+        their host name.
+
+    Url.open reports the outcome of every request. After
+        Network.circuitfailures consecutive failures (connection errors,
+        timeouts, 5xx or 429 responses) the circuit opens and searches skip
+        the indexer instead of waiting out the timeout on every request.
+
+    An open circuit allows a single retry after Network.circuitbackoff
+        seconds. Each failed retry doubles the wait, up to
+        Network.circuitmaxbackoff seconds. Any successful request closes the
+        circuit.
+
+    Search paths call allow() before sending requests to an indexer. Other
+        requests, such as connection tests, are never blocked and close the
+        circuit if they succeed.
+    '''
+
+    # {key: {'failures': int, 'retry': float or None, 'last_error': str, 'last_success': float or None}}
+    circuits = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def key(url):
+        ''' Gets key of circuit url belongs to
+        url: str url of request, indexer url base, or host name
+
+        Returns str lowercase url base of the indexer url belongs to, or lowercase
+            host name if url is not under a NewzNab or TorzNab indexer
+        '''
+
+        url = url.lower()
+        if '://' not in url:
+            url = u'http://{}'.format(url)
+
+        # trailing slash so bases only match whole path segments
+        path = url.split('?')[0].rstrip('/') + '/'
+
+        key = None
+        if core.CONFIG:
+            for kind in ('NewzNab', 'TorzNab'):
+                for indexer in core.CONFIG['Indexers'][kind].values():
+                    base = indexer[0].lower().rstrip('/') + '/'
+                    if base != '/' and path.startswith(base) and len(base) > len(key or ''):
+                        key = base
+        return key or (urlparse.urlsplit(url).hostname or u'')
+
+    @staticmethod
+    def allow(url):
+        ''' Checks if requests may be sent to url
+        url: str url of request
+
+        If the circuit is open and its retry is due, the retry is handed to
+            this caller and pushed back for everyone else until the outcome
+            is reported.
+
+        Returns Bool
+        '''
+
+        key = CircuitBreaker.key(url)
+        now = time.time()
+
+        with CircuitBreaker.lock:
+            state = CircuitBreaker.circuits.get(key)
+            if state is None or state['retry'] is None:
+                return True
+            if now < state['retry']:
+                return False
+
+            state['retry'] = now + CircuitBreaker._backoff(state['failures'])
+            logging.info(u'Retrying {} after {} failures.'.format(key, state['failures']))
+            return True
+
+    @staticmethod
+    def success(url):
+        ''' Records successful request to url
+        url: str url of request
+
+        Does not return
+        '''
+
+        key = CircuitBreaker.key(url)
+
+        with CircuitBreaker.lock:
+            state = CircuitBreaker.circuits.setdefault(key, CircuitBreaker._new_state())
+            if state['retry'] is not None:
+                logging.info(u'{} is responding again, closing circuit.'.format(key))
+            state['failures'] = 0
+            state['retry'] = None
+            state['last_success'] = time.time()
+        return
+
+    @staticmethod
+    def failure(url, error):
+        ''' Records failed request to url
+        url: str url of request
+        error: exception raised by request
+
+        Does not return
+        '''
+
+        key = CircuitBreaker.key(url)
+        threshold = core.CONFIG['Network']['circuitfailures'] if core.CONFIG else 3
+
+        with CircuitBreaker.lock:
+            state = CircuitBreaker.circuits.setdefault(key, CircuitBreaker._new_state())
+            state['failures'] += 1
+            state['last_error'] = u'{}'.format(error)
+            if threshold > 0 and state['failures'] >= threshold:
+                backoff = CircuitBreaker._backoff(state['failures'])
+                state['retry'] = time.time() + backoff
+                logging.warning(u'{} failed {} times in a row, skipping it for {} seconds.'.format(key, state['failures'], backoff))
+        return
+
+    @staticmethod
+    def _new_state():
+        return {'failures': 0, 'retry': None, 'last_error': None, 'last_success': None}
+
+    @staticmethod
+    def _backoff(failures):
+        ''' Gets seconds to wait before retrying circuit
+        failures: int consecutive failures
+
+        Returns int
+        '''
+
+        conf = core.CONFIG['Network'] if core.CONFIG else {}
+        threshold = max(conf.get('circuitfailures', 3), 1)
+        base = conf.get('circuitbackoff', 60)
+        limit = conf.get('circuitmaxbackoff', 3600)
+        return min(base * 2 ** min(max(failures - threshold, 0), 16), limit)
+
+    @staticmethod
+    def status():
+        ''' Gets health of every indexer and host contacted since start
+
+        Returns list of dicts sorted by indexer
+        '''
+
+        def fmt(t):
+            return datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') if t else None
+
+        with CircuitBreaker.lock:
+            return [{'indexer': key,
+                     'state': u'open' if state['retry'] is not None else u'closed',
+                     'failures': state['failures'],
+                     'retry': fmt(state['retry']),
+                     'last_error': state['last_error'],
+                     'last_success': fmt(state['last_success'])
+                     } for key, state in sorted(CircuitBreaker.circuits.iteritems())]
+
+    @staticmethod
+    def get(url):
+        ''' Gets health of url's circuit
+        url: str url, indexer url base, or host name
+
+        Returns dict from status(), or None if it has not been contacted
+        '''
+
+        key = CircuitBreaker.key(url)
+        for i in CircuitBreaker.status():
+            if i['indexer'] == key:
+                return i
+        return None
+
 
 class Url(object):
     ''' Creates url requests and sanitizes urls '''
@@ -24,6 +291,10 @@ class Url(object):
 
     trans = {i: u' ' for i in map(ord, '+.-_')}
 
+    # Validators from the last response to each url opened conditionally. {url: {header: value}}
+    validators = {}
+    validators_lock = threading.Lock()
+
     @staticmethod
     def request(url, post_data=None, headers={}):
 
@@ -48,18 +319,139 @@ class Url(object):
         return s
 
     @staticmethod
-    def open(request, timeout=30):
+    def open(request, timeout=30, conditional=False, opener=None, proxy=False, pending=None):
         ''' Opens and reads request
         request: object urllib2 request
+        timeout: int seconds to wait for response <optional - default 30>
+        conditional: bool only download body if changed since last request <optional - default False>
+        opener: object urllib2 opener to send request with instead of the direct opener <optional>
+        proxy: bool send through configured proxy unless url is whitelisted, see Proxy.opener <optional - default False>
+        pending: dict to hold validators of a conditional request until Url.save_validators() is called <optional>
+
+        Waits for the host's rate limit before sending, see RateLimiter. The
+            outcome is reported to CircuitBreaker.
+
+        Requests reuse keep-alive connections to the host, see
+            core.httppool.ConnectionPool.
 
-        Returns... well... whatever the request read() is. Some kind of bytes.
+        Conditional requests send the ETag and Last-Modified validators of the
+            last response from the same url. If the server answers 304 Not
+            Modified nothing is downloaded and None is returned, so callers
+            must treat None as 'nothing new'.
+
+        New validators are used by the next request unless pending is passed.
+            Then they are only stored in pending, so a caller that fails to
+            process the response can discard them and get the same response
+            again next time.
+
+        Returns... well... whatever the request read() is. Some kind of bytes. Or None if not modified.
         '''
 
-        r = urllib2.urlopen(request, timeout=timeout)
-        response = r.read()
-        r.close()
+        url = request.get_full_url()
+
+        RateLimiter.acquire(url)
+
+        if opener is None:
+            opener = Proxy.opener(url) if proxy else Proxy.direct_opener
+
+        if conditional:
+            with Url.validators_lock:
+                for header, value in Url.validators.get(url, {}).iteritems():
+                    request.add_header(header, value)
+
+        try:
+            r = opener.open(request, timeout=timeout)
+            response = r.read()
+            r.close()
+        except urllib2.HTTPError as e:
+            if e.code >= 500 or e.code == 429:
+                CircuitBreaker.failure(url, e)
+                raise
+            CircuitBreaker.success(url)
+            if conditional and e.code == 304:
+                e.close()
+                return None
+            raise
+        except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+            CircuitBreaker.failure(url, e)
+            raise
+
+        CircuitBreaker.success(url)
+
+        if conditional:
+            validators = {}
+            if r.info().getheader('ETag'):
+                validators['If-None-Match'] = r.info().getheader('ETag')
+            if r.info().getheader('Last-Modified'):
+                validators['If-Modified-Since'] = r.info().getheader('Last-Modified')
+            if pending is not None:
+                pending[url] = validators
+            else:
+                Url.save_validators({url: validators})
+
         return response
 
+    @staticmethod
+    def save_validators(pending):
+        ''' Stores validators for the next conditional requests
+        pending: dict {url: {header: value}} from Url.open
+
+        Urls with empty validators are forgotten.
+
+        Does not return
+        '''
+
+        with Url.validators_lock:
+            for url, validators in pending.iteritems():
+                if validators:
+                    Url.validators[url] = validators
+                else:
+                    Url.validators.pop(url, None)
+        return
+
+
+class UrlTransport(xmlrpclib.Transport):
+    ''' xmlrpclib transport that sends calls with Url.open
+
+    Lets xmlrpclib.ServerProxy clients reuse pooled keep-alive connections
+        instead of connecting for every call.
+
+    Usage: ServerProxy(url, transport=UrlTransport())
+    '''
+
+    def __init__(self, https=False):
+        xmlrpclib.Transport.__init__(self)
+        self.scheme = u'https' if https else u'http'
+
+    def request(self, host, handler, request_body, verbose=0):
+        ''' Sends xmlrpc call
+        host: str host from ServerProxy url
+        handler: str path from ServerProxy url
+        request_body: str marshalled call
+        verbose: int unused
+
+        Raises xmlrpclib.ProtocolError on http errors, like xmlrpclib.Transport
+
+        Returns tuple of unmarshalled response
+        '''
+
+        host, extra_headers, x509 = self.get_host_info(host)
+
+        headers = dict(extra_headers or [])
+        headers['Content-Type'] = 'text/xml'
+
+        request = Url.request(u'{}://{}{}'.format(self.scheme, host, handler), post_data=request_body, headers=headers)
+
+        try:
+            response = Url.open(request)
+        except urllib2.HTTPError as e:
+            raise xmlrpclib.ProtocolError(host + handler, e.code, e.msg, e.headers)
+
+        parser, unmarshaller = self.getparser()
+        parser.feed(response)
+        parser.close()
+        return unmarshaller.close()
+
 
 class Conversions(object):
     ''' Coverts data formats. '''
@@ -108,7 +500,7 @@ class Torrent(object):
         else:
             try:
                 req = urllib2.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-                torrent = urllib2.urlopen(req).read()
+                torrent = Url.open(req)
                 metadata = bencode.bdecode(torrent)
                 hashcontents = bencode.bencode(metadata['info'])
                 return hashlib.sha1(hashcontents).hexdigest()
@@ -0,0 +1,223 @@
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+from cStringIO import StringIO
+
+import core
+import logging
+
+logging = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    ''' Keeps idle HTTP connections open for reuse
+
+    Connections are stored by (pool key, host, tunnel host) after their
+        response has been read. A request to the same host takes the most
+        recently used connection instead of opening a new socket and
+        repeating the TCP and TLS handshakes.
+
+    At most Network.poolsize idle connections are kept per host, extras are
+        closed. Connections idle for more than Network.poolidle seconds are
+        closed the next time the pool is used.
+    '''
+
+    # {key: [(float time returned, connection)]}
+    idle = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(key):
+        ''' Takes idle connection from pool
+        key: tuple pool key
+
+        Returns object httplib.HTTPConnection, or None if none are idle
+        '''
+
+        with ConnectionPool.lock:
+            expired = ConnectionPool._evict()
+            conns = ConnectionPool.idle.get(key)
+            conn = conns.pop()[1] if conns else None
+
+        for i in expired:
+            i.close()
+        return conn
+
+    @staticmethod
+    def put(key, conn):
+        ''' Returns connection to pool
+        key: tuple pool key
+        conn: object httplib.HTTPConnection with its response fully read
+
+        Closes connection if the host already has Network.poolsize idle.
+
+        Does not return
+        '''
+
+        size = core.CONFIG['Network']['poolsize'] if core.CONFIG else 4
+
+        with ConnectionPool.lock:
+            expired = ConnectionPool._evict()
+            conns = ConnectionPool.idle.setdefault(key, [])
+            if len(conns) < size:
+                conns.append((time.time(), conn))
+            else:
+                expired.append(conn)
+
+        for i in expired:
+            i.close()
+        return
+
+    @staticmethod
+    def _evict():
+        ''' Removes connections idle too long
+
+        Must be called while holding ConnectionPool.lock.
+
+        Returns list of removed connections to close
+        '''
+
+        max_idle = core.CONFIG['Network']['poolidle'] if core.CONFIG else 60
+        cutoff = time.time() - max_idle
+
+        expired = []
+        for key, conns in ConnectionPool.idle.items():
+            expired += [c for t, c in conns if t < cutoff]
+            conns = [(t, c) for t, c in conns if t >= cutoff]
+            if conns:
+                ConnectionPool.idle[key] = conns
+            else:
+                del ConnectionPool.idle[key]
+        return expired
+
+    @staticmethod
+    def clear():
+        ''' Closes all idle connections
+
+        Does not return
+        '''
+
+        with ConnectionPool.lock:
+            conns = [c for i in ConnectionPool.idle.values() for t, c in i]
+            ConnectionPool.idle = {}
+
+        for i in conns:
+            i.close()
+        return
+
+    @staticmethod
+    def stats():
+        ''' Gets number of idle connections for each host
+
+        Returns dict {str host: int idle connections}
+        '''
+
+        stats = {}
+        with ConnectionPool.lock:
+            for key, conns in ConnectionPool.idle.items():
+                host = key[2] or key[1]
+                stats[host] = stats.get(host, 0) + len(conns)
+        return stats
+
+
+class PooledHandlerMixin(object):
+    ''' Sends urllib2 requests over pooled keep-alive connections
+
+    Replaces urllib2's do_open, which always sends 'Connection: close'.
+        The response body is read completely before returning so the
+        connection can go back to the pool straight away. All callers read
+        the entire response anyway, see Url.open.
+
+    A reused connection may have been closed by the server while idle. If
+        one fails the request is sent again on the next idle connection, or a
+        new one once the host has none left. Requests other than GET and HEAD
+        are only sent again if the failure happened before the request was
+        fully sent, so the server cannot act on them twice (ie adding a
+        download to a downloader).
+
+    pool_key separates connections that reach the same host differently,
+        ie directly or through a SOCKS proxy.
+    '''
+
+    pool_key = 'direct'
+
+    def pooled_open(self, connection, req):
+        ''' Sends request using pooled connection
+        connection: callable that creates a new connection as connection(host, timeout=timeout)
+        req: object urllib2 request
+
+        Returns object urllib.addinfourl
+        '''
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        key = (self.pool_key, host, req._tunnel_host)
+
+        while True:
+            conn = ConnectionPool.get(key)
+            reused = conn is not None
+            if reused:
+                conn.timeout = req.timeout
+                if conn.sock and req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    conn.sock.settimeout(req.timeout)
+            else:
+                conn = connection(host, timeout=req.timeout)
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+
+            sent = False
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                sent = True
+                r = conn.getresponse(buffering=True)
+                body = r.read()
+            except socket.timeout as e:
+                conn.close()
+                raise urllib2.URLError(e)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if reused and (not sent or req.get_method() in ('GET', 'HEAD')):
+                    logging.debug(u'Pooled connection to {} was closed, reconnecting.'.format(host))
+                    continue
+                raise urllib2.URLError(e)
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            ConnectionPool.put(key, conn)
+
+        resp = urllib.addinfourl(StringIO(body), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class PooledHTTPHandler(PooledHandlerMixin, urllib2.HTTPHandler):
+    ''' urllib2 http handler with keep-alive connections '''
+
+    def http_open(self, req):
+        return self.pooled_open(httplib.HTTPConnection, req)
+
+
+class PooledHTTPSHandler(PooledHandlerMixin, urllib2.HTTPSHandler):
+    ''' urllib2 https handler with keep-alive connections '''
+
+    def https_open(self, req):
+        return self.pooled_open(self.connection, req)
+
+    def connection(self, host, **kwargs):
+        return httplib.HTTPSConnection(host, context=self._context, **kwargs)
@@ -29,4 +29,10 @@ class log(object):
         logger.addHandler(handler)
         logger.setLevel(logging_level)
 
+        # slow sql queries also get their own file, see core.sqldb.SQL._record()
+        slow_logfile = os.path.join(path, 'slow_queries.txt')
+        slow_handler = logging.handlers.TimedRotatingFileHandler(slow_logfile, when="D", interval=1, backupCount=backup_days)
+        slow_handler.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
+        logging.getLogger('core.sqldb.slow').addHandler(slow_handler)
+
         return
@@ -1,32 +1,19 @@
 import json
 import logging
-from time import time, sleep
 from core.helpers import Comparisons, Url
-import core
 _k = Comparisons._k
 
 logging = logging.getLogger(__name__)
 
 
 class TMDB(object):
+    ''' TMDB api requests are rate limited by the api.themoviedb.org entry in
+        Network.ratelimits, see helpers.RateLimiter.
+    '''
 
     def __init__(self):
-        self.cap = 30
-        if not core.TMDB_LAST_FILL:
-            core.TMDB_LAST_FILL = time()
         return
 
-    def get_tokens(self):
-        if core.TMDB_TOKENS < self.cap:
-            now = time()
-            if (now - core.TMDB_LAST_FILL) > 10:
-                core.TMDB_TOKENS = self.cap
-                core.TMDB_LAST_FILL = time()
-        return core.TMDB_TOKENS
-
-    def use_token(self):
-        core.TMDB_TOKENS -= 1
-
     def search(self, search_term, single=False):
         ''' Search TMDB for all matches
         :param search_term: str title of movie to search for.
@@ -77,10 +64,6 @@ class TMDB(object):
 
         request = Url.request(url)
 
-        while self.get_tokens() < 3:
-            sleep(0.3)
-        self.use_token()
-
         try:
             response = Url.open(request)
             results = json.loads(response)
@@ -102,10 +85,6 @@ class TMDB(object):
         url = url + '&api_key={}'.format(_k('tmdb'))
         request = Url.request(url)
 
-        while self.get_tokens() < 3:
-            sleep(0.5)
-        self.use_token()
-
         try:
             response = Url.open(request)
             results = json.loads(response)
@@ -131,10 +110,6 @@ class TMDB(object):
 
         request = Url.request(url)
 
-        while self.get_tokens() < 3:
-            sleep(0.3)
-        self.use_token()
-
         try:
             response = Url.open(request)
             results = json.loads(response)
@@ -172,10 +147,6 @@ class TMDB(object):
             url = u'https://api.themoviedb.org/3/search/movie?api_key={}&language=en-US&query={}&year={}&page=1&include_adult=false'.format(_k('tmdb'), title, year)
             request = Url.request(url)
 
-            while self.get_tokens() < 3:
-                sleep(0.3)
-            self.use_token()
-
             try:
                 response = Url.open(request)
                 results = json.loads(response)
@@ -193,10 +164,6 @@ class TMDB(object):
         url = u'https://api.themoviedb.org/3/movie/{}?api_key={}'.format(tmdbid, _k('tmdb'))
         request = Url.request(url)
 
-        while self.get_tokens() < 3:
-            sleep(0.3)
-        self.use_token()
-
         try:
             response = Url.open(request)
             results = json.loads(response)
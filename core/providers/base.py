@@ -1,10 +1,437 @@
 import xml.etree.cElementTree as ET
+import base64
+import collections
 import urllib
+import urlparse
 import logging
+import Queue
+import re
+import threading
+import time
 
 import core
-from core.helpers import Url
-from core.proxy import Proxy
+from core import sqldb
+from core.helpers import CircuitBreaker, Url
+
+
+class Fanout(object):
+    ''' Runs indexer searches concurrently
+
+    Each task runs in its own daemon thread, with at most Network.searchworkers
+        (at least 1) threads alive at once. Results are collected as they arrive.
+
+    A task that runs longer than Network.indexertimeout seconds is abandoned and
+        its result discarded. Its thread keeps its slot until it actually
+        finishes, so abandoned threads never push the number of threads over
+        the limit. Any task still running or waiting when Network.searchtimeout
+        seconds have passed is skipped and left to finish in the background.
+
+    Tasks for indexers whose circuit is open are skipped, see CircuitBreaker.
+    '''
+
+    @staticmethod
+    def run(tasks):
+        ''' Runs tasks and gathers their results
+        tasks: list of tuples (str name, str indexer url, function, tuple args)
+
+        Each function must return a list. Exceptions are logged and treated as
+            an empty list.
+
+        Returns list of tuples (str name, list results) in the order they finished
+        '''
+
+        workers = max(core.CONFIG['Network']['searchworkers'], 1)
+        task_timeout = core.CONFIG['Network']['indexertimeout']
+
+        available = []
+        for task in tasks:
+            if CircuitBreaker.allow(task[1]):
+                available.append(task)
+            else:
+                logging.info(u'{} is unavailable, skipping.'.format(task[0]))
+        tasks = available
+
+        finished = Queue.Queue()
+        pending = list(enumerate(tasks))
+        # {idx: deadline}
+        running = {}
+        # idx of timed out tasks whose threads have not finished
+        abandoned = set()
+        results = []
+
+        def work(idx, name, func, args):
+            try:
+                r = func(*args)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception, e: # noqa
+                logging.error(u'{} search failed.'.format(name), exc_info=True)
+                r = []
+            finished.put((idx, r))
+
+        start = time.time()
+        deadline = start + core.CONFIG['Network']['searchtimeout']
+
+        while pending or running:
+            while pending and len(running) + len(abandoned) < workers:
+                idx, (name, url, func, args) = pending.pop(0)
+                t = threading.Thread(target=work, args=(idx, name, func, args))
+                t.daemon = True
+                t.start()
+                running[idx] = time.time() + task_timeout
+
+            wait = min(running.values() + [deadline]) - time.time()
+            try:
+                idx, r = finished.get(timeout=max(wait, 0.01))
+                if idx in running:
+                    del running[idx]
+                    results.append((tasks[idx][0], r))
+                else:
+                    abandoned.discard(idx)
+                continue
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            for idx, task_deadline in running.items():
+                if now >= task_deadline:
+                    logging.warning(u'{} did not respond within {} seconds, skipping.'.format(tasks[idx][0], task_timeout))
+                    del running[idx]
+                    abandoned.add(idx)
+
+            if now >= deadline:
+                for idx in running.keys() + [i[0] for i in pending]:
+                    logging.warning(u'Search deadline reached, skipping {}.'.format(tasks[idx][0]))
+                break
+
+        logging.info(u'Searched {} of {} indexers in {:.2f} seconds.'.format(len(results), len(tasks), time.time() - start))
+        return results
+
+
+class SearchCache(object):
+    ''' Short-lived cache of indexer search responses
+
+    Forced searches, the search after adding a movie and the next backlog
+        search often ask the same indexers for the same movie within minutes.
+        Responses are kept for Network.searchcachettl seconds so the repeats
+        are answered without another request to the indexer.
+
+    Raw response bodies are cached, so every hit is parsed into new result
+        dicts and callers are free to modify them. Failed requests and
+        responses that are not a valid result set (ie an indexer's error
+        message) are never cached.
+
+    At most Network.searchcachesize responses are kept, the least recently
+        used are dropped first. A ttl or size of 0 disables the cache.
+    '''
+
+    # {key: (float expires, str response)}, least recently used first
+    entries = collections.OrderedDict()
+    lock = threading.Lock()
+    hits = 0
+    misses = 0
+
+    # Query parameters that change between otherwise identical requests
+    ignore_params = ('token',)
+
+    @staticmethod
+    def key(url):
+        ''' Normalizes url into cache key
+        url: str request url
+
+        Lowercases scheme and host, sorts query parameters and drops any in
+            SearchCache.ignore_params.
+
+        Returns str
+        '''
+
+        parts = urlparse.urlsplit(url)
+        query = sorted((k, v) for k, v in urlparse.parse_qsl(parts.query, keep_blank_values=True) if k not in SearchCache.ignore_params)
+        return u'{}://{}{}?{}'.format(parts.scheme.lower(), parts.netloc.lower(), parts.path, urllib.urlencode(query))
+
+    @staticmethod
+    def get(key):
+        ''' Gets cached response
+        key: str cache key from SearchCache.key()
+
+        Returns str response or None if not cached or expired
+        '''
+
+        with SearchCache.lock:
+            entry = SearchCache.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                SearchCache.misses += 1
+                return None
+
+            SearchCache.entries[key] = entry
+            SearchCache.hits += 1
+            return entry[1]
+
+    @staticmethod
+    def put(key, response):
+        ''' Stores response in cache
+        key: str cache key from SearchCache.key()
+        response: str response body
+
+        Does not return
+        '''
+
+        ttl = core.CONFIG['Network']['searchcachettl']
+        size = core.CONFIG['Network']['searchcachesize']
+        if ttl <= 0 or size <= 0:
+            return
+
+        with SearchCache.lock:
+            SearchCache.entries.pop(key, None)
+            SearchCache.entries[key] = (time.time() + ttl, response)
+            while len(SearchCache.entries) > size:
+                SearchCache.entries.popitem(last=False)
+        return
+
+    @staticmethod
+    def fetch(request, valid):
+        ''' Gets response from cache or by sending request
+        request: object urllib2 request
+        valid: function that takes str response and returns Bool if it is a result set worth caching
+
+        Requests are sent through the configured proxy, see Proxy.opener.
+
+        Exceptions from the request are raised to the caller.
+
+        Returns str response
+        '''
+
+        key = SearchCache.key(request.get_full_url())
+
+        response = SearchCache.get(key)
+        if response is not None:
+            logging.info(u'Using cached response for {}.'.format(urlparse.urlsplit(key).netloc))
+            return response
+
+        response = Url.open(request, proxy=True)
+
+        if valid(response):
+            SearchCache.put(key, response)
+        else:
+            logging.info(u'Not caching error response from {}.'.format(urlparse.urlsplit(key).netloc))
+        return response
+
+    @staticmethod
+    def valid_xml(response):
+        ''' Checks if response is an xml feed
+        response: str response body
+
+        Newznab style <error> documents are not valid.
+
+        Returns Bool
+        '''
+
+        try:
+            return ET.fromstring(response).tag != 'error'
+        except ET.ParseError:
+            return False
+
+    @staticmethod
+    def stats():
+        ''' Gets cache statistics
+
+        Returns dict
+        '''
+
+        with SearchCache.lock:
+            lookups = SearchCache.hits + SearchCache.misses
+            return {'entries': len(SearchCache.entries),
+                    'hits': SearchCache.hits,
+                    'misses': SearchCache.misses,
+                    'hit_rate': round(float(SearchCache.hits) / lookups, 3) if lookups else 0.0
+                    }
+
+    @staticmethod
+    def clear():
+        ''' Empties cache and resets statistics
+
+        Does not return
+        '''
+
+        with SearchCache.lock:
+            SearchCache.entries.clear()
+            SearchCache.hits = 0
+            SearchCache.misses = 0
+        return
+
+
+class ResultMerger(object):
+    ''' Merges results from several providers into one de-duplicated list
+
+    Torrents are keyed on their info hash when one can be found in the guid or
+        torrent link, everything else on the lowercased guid. The same torrent from
+        two providers therefore merges even if titles, links or sizes differ.
+
+    When two results share a key the richer one is kept (more seeders, then
+        more filled-in fields) in the position the key was first seen. Results
+        with neither guid nor info hash are never merged.
+
+    Usage:
+        merger = ResultMerger()
+        merger.add('Rarbg', rarbg_results)
+        merger.add('LimeTorrents', lime_results)
+        results = merger.results()
+    '''
+
+    btih = re.compile(r'btih:([0-9a-z]{40}|[a-z2-7]{32})(?![0-9a-z])')
+    # Hash as the last path segment of a link, eg https://itorrents.org/torrent/<hash>.torrent
+    hash_file = re.compile(r'/([0-9a-f]{40})(?:\.torrent)?(?:[?#]|$)')
+    bare_hash = re.compile(r'^(?:[0-9a-f]{40}|[a-z2-7]{32})$')
+
+    def __init__(self):
+        self.merged = []
+        # {key: index in self.merged}
+        self.keys = {}
+        # {provider: [int results, int duplicates]}
+        self.counts = {}
+        return
+
+    def add(self, provider, results):
+        ''' Adds provider's results to merged list
+        provider: str name of provider
+        results: list of dicts of search results
+
+        Does not return
+        '''
+
+        counts = self.counts.setdefault(provider, [0, 0])
+        for result in results:
+            counts[0] += 1
+            key = self.key(result)
+            if not key:
+                self.merged.append(result)
+                continue
+            idx = self.keys.get(key)
+            if idx is None:
+                self.keys[key] = len(self.merged)
+                self.merged.append(result)
+                continue
+
+            counts[1] += 1
+            if self.rank(result) > self.rank(self.merged[idx]):
+                self.merged[idx] = result
+        return
+
+    def results(self):
+        ''' Gets merged results and logs overlap between providers
+
+        Returns list of dicts
+        '''
+
+        for provider, (total, duplicates) in self.counts.iteritems():
+            if duplicates:
+                logging.info(u'{} returned {} results, {} already found by another provider.'.format(provider, total, duplicates))
+        logging.info(u'Merged {} results from {} providers into {} unique results.'.format(sum(i[0] for i in self.counts.values()), len(self.counts), len(self.merged)))
+        return self.merged
+
+    def key(self, result):
+        ''' Gets de-duplication key for result
+        result: dict of search result
+
+        Returns str lowercase hex info hash or guid, or empty str if result has neither
+        '''
+
+        guid = (result.get('guid') or u'').strip().lower()
+        if result.get('type') not in ('torrent', 'magnet'):
+            return guid
+
+        if self.bare_hash.match(guid):
+            return self.normalize_hash(guid)
+        for link in (guid, (result.get('torrentfile') or u'').lower()):
+            match = self.btih.search(link) or self.hash_file.search(link)
+            if match:
+                return self.normalize_hash(match.group(1))
+        return guid
+
+    @staticmethod
+    def normalize_hash(info_hash):
+        ''' Converts base32 info hash to hex
+        info_hash: str 40 character hex or 32 character base32 info hash
+
+        Returns str lowercase hex info hash
+        '''
+
+        if len(info_hash) == 32:
+            try:
+                return base64.b32decode(info_hash.upper()).encode('hex')
+            except TypeError:
+                return info_hash
+        return info_hash
+
+    @staticmethod
+    def rank(result):
+        ''' Ranks how useful a result is when choosing between duplicates
+        result: dict of search result
+
+        Returns tuple to compare
+        '''
+
+        return (result.get('seeders') or 0, len([i for i in result.values() if i not in (None, u'', 0)]))
+
+
+class RssCheckpoint(object):
+    ''' Skips rss items already seen on a previous sync
+
+    Feeds list their newest items first. The guid of the newest item from each
+        indexer is stored in RSSCHECKPOINTS, and on the next sync only items
+        above it in the feed are processed. If the stored guid has dropped off
+        the end of the feed every item is new.
+
+    New checkpoints are kept in memory until save() is called, so if a sync
+        fails before its results are stored the same items are processed again.
+        The same goes for the ETag and Last-Modified validators of each feed,
+        which are collected through Url.open's pending and only saved with the
+        checkpoints. Otherwise the feed would answer 304 Not Modified next time.
+    '''
+
+    def __init__(self):
+        self.sql = sqldb.SQL()
+        self.seen = self.sql.get_rss_checkpoints() or {}
+        self.pending = {}
+        # {url: {header: value}} for Url.open
+        self.validators = {}
+        return
+
+    def new_items(self, indexer, items):
+        ''' Removes items already seen from indexer's feed
+        indexer: str name or url of indexer
+        items: list of dicts of rss items, newest first
+
+        Returns list of dicts of new items
+        '''
+
+        last = self.seen.get(indexer)
+
+        new = []
+        for i in items:
+            if i['guid'] == last:
+                break
+            new.append(i)
+
+        if items:
+            self.pending[indexer] = items[0]['guid']
+
+        logging.info(u'RSS_SYNC: {} new of {} items from {}.'.format(len(new), len(items), indexer))
+        return new
+
+    def save(self):
+        ''' Stores checkpoints of every feed read since this was created
+
+        Returns Bool
+        '''
+
+        if not self.sql.set_rss_checkpoints(self.pending):
+            return False
+        self.seen.update(self.pending)
+        self.pending = {}
+        Url.save_validators(self.validators)
+        self.validators = {}
+        return True
 
 
 class NewzNabProvider(object):
@@ -19,7 +446,6 @@ class NewzNabProvider(object):
         import xml.etree.cElementTree as ET
         import urllib2
         from core.helpers import Url
-        from core.proxy import Proxy
         from core.providers.base import NewzNabProvider
 
     '''
@@ -32,6 +458,8 @@ class NewzNabProvider(object):
 
         Creates url based off url_base. Appends url-encoded **params to url.
 
+        Responses are cached briefly, see SearchCache.
+
         Returns list of dicts of search results
         '''
 
@@ -39,15 +467,10 @@ class NewzNabProvider(object):
 
         logging.info(u'SEARCHING: {}api?apikey=APIKEY&{}'.format(url_base, urllib.urlencode(params)))
 
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         request = Url.request(url)
 
         try:
-            if proxy_enabled and Proxy.whitelist(url) is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = SearchCache.fetch(request, SearchCache.valid_xml)
 
             return self.parse_newznab_xml(response)
         except (SystemExit, KeyboardInterrupt):
@@ -56,16 +479,15 @@ class NewzNabProvider(object):
             logging.error(u'Newz/TorzNab backlog search.', exc_info=True)
             return []
 
-    def _get_rss(self):
+    def _get_rss(self, checkpoint=None):
         ''' Get latest uploads from all indexers
+        checkpoint: object RssCheckpoint to skip items seen on previous syncs <optional>
 
         Returns list of dicts with parsed nzb info
         '''
 
         self.imdbid = None
 
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         if self.feed_type == 'nzb':
             indexers = core.CONFIG['Indexers']['NewzNab'].values()
         else:
@@ -81,6 +503,10 @@ class NewzNabProvider(object):
                 url_base = url_base + '/'
             apikey = indexer[1]
 
+            if not CircuitBreaker.allow(url_base):
+                logging.info(u'RSS_SYNC: {} is unavailable, skipping.'.format(url_base))
+                continue
+
             url = u'{}api?t=movie&cat=2000&extended=1&offset=0&apikey={}'.format(url_base, apikey)
 
             logging.info(u'RSS_SYNC: {}api?t=movie&cat=2000&extended=1&offset=0&apikey=APIKEY'.format(url_base))
@@ -88,16 +514,25 @@ class NewzNabProvider(object):
             request = Url.request(url)
 
             try:
-                if proxy_enabled and Proxy.whitelist(url) is True:
-                    response = Proxy.bypass(request)
-                else:
-                    response = Url.open(request)
+                response = Url.open(request, conditional=True, proxy=True, pending=checkpoint.validators if checkpoint else None)
+
+                if response is None:
+                    logging.info(u'RSS_SYNC: {} feed not modified since last sync.'.format(url_base))
+                    continue
 
-                return self.parse_newznab_xml(response)
+                items = self.parse_newznab_xml(response)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except Exception, e: # noqa
+                # not processed, so fetch the whole feed again next time
+                if checkpoint:
+                    checkpoint.validators.pop(url, None)
                 logging.error(u'Newz/TorzNab rss get xml.', exc_info=True)
+                continue
+
+            if checkpoint:
+                items = checkpoint.new_items(url_base, items)
+            results += items
 
         return results
 
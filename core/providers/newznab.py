@@ -1,7 +1,7 @@
 import logging
 
 import core
-from core.providers.base import NewzNabProvider
+from core.providers.base import Fanout, NewzNabProvider, ResultMerger
 
 logging = logging.getLogger(__name__)
 
@@ -24,9 +24,9 @@ class NewzNab(NewzNabProvider):
 
         self.imdbid = imdbid
 
-        results = []
         imdbid_s = imdbid[2:]  # just imdbid numbers
 
+        tasks = []
         for indexer in indexers:
             if indexer[2] is False:
                 continue
@@ -35,12 +35,33 @@ class NewzNab(NewzNabProvider):
                 url_base = url_base + '/'
             apikey = indexer[1]
 
-            r = self.search_newznab(url_base, apikey, t='movie', imdbid=imdbid_s)
-            for i in r:
-                results.append(i)
+            tasks.append((url_base, url_base, self._search_indexer, (url_base, apikey, imdbid_s)))
+
+        merger = ResultMerger()
+        for name, r in Fanout.run(tasks):
+            merger.add(name, r)
 
         self.imdbid = None
-        return results
+        return merger.results()
+
+    def _search_indexer(self, url_base, apikey, imdbid_s):
+        ''' Searches single indexer for movie
+        url_base: str base url for all requests (https://indexer.com/)
+        apikey: str api key for indexer
+        imdbid_s: str imdb id # without 'tt'
+
+        Helper for search_all, run by Fanout.
+
+        Returns list of dicts of search results
+        '''
+
+        return self.search_newznab(url_base, apikey, t='movie', imdbid=imdbid_s)
+
+    def get_rss(self, checkpoint=None):
+        ''' Gets rss from all newznab providers
+        checkpoint: object RssCheckpoint to skip items seen on previous syncs <optional>
+
+        Returns list of dicts of latest movies
+        '''
 
-    def get_rss(self):
-        return self._get_rss()
+        return self._get_rss(checkpoint=checkpoint)
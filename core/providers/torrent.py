@@ -1,12 +1,10 @@
 import json
 import logging
-import datetime
-import time
+import threading
 import xml.etree.cElementTree as ET
 import core
-from core.proxy import Proxy
-from core.helpers import Url
-from core.providers.base import NewzNabProvider
+from core.helpers import CircuitBreaker, Url
+from core.providers.base import Fanout, NewzNabProvider, ResultMerger, SearchCache
 
 
 logging = logging.getLogger(__name__)
@@ -20,6 +18,16 @@ class Torrent(NewzNabProvider):
                 'udp://public.popcorn-tracker.org:6969'
                 ]
 
+    # Base url of each torrent indexer. {Indexers.Torrent key: url}
+    urls = {'bitsnoop': 'https://www.bitsnoop.com',
+            'extratorrent': 'https://www.extratorrent.cc',
+            'limetorrents': 'https://www.limetorrents.cc',
+            'rarbg': 'https://www.torrentapi.org',
+            'skytorrents': 'https://www.skytorrents.in',
+            'thepiratebay': 'https://www.thepiratebay.org',
+            'torrentz2': 'https://www.torrentz2.eu'
+            }
+
     def __init__(self):
         self.feed_type = 'torrent'
         return
@@ -37,10 +45,9 @@ class Torrent(NewzNabProvider):
 
         self.imdbid = imdbid
 
-        results = []
-
         term = '{}+{}'.format(title, year).replace(' ', '+')
 
+        tasks = []
         for indexer in torz_indexers:
             if indexer[2] is False:
                 continue
@@ -49,125 +56,130 @@ class Torrent(NewzNabProvider):
                 url_base = url_base + '/'
             apikey = indexer[1]
 
-            r = self.search_newznab(url_base, apikey, t='search', cat=2000, q=imdbid)
-            for i in r:
-                results.append(i)
+            tasks.append((url_base, url_base, self._search_torznab, (url_base, apikey, imdbid)))
 
         torrent_indexers = core.CONFIG['Indexers']['Torrent']
-
-        title = Url.encode(title)
-        year = Url.encode(year)
+        urls = Torrent.urls
 
         if torrent_indexers['rarbg']:
-            rarbg_results = Rarbg.search(imdbid)
-            for i in rarbg_results:
-                if i not in results:
-                    results.append(i)
+            tasks.append(('Rarbg', urls['rarbg'], Rarbg.search, (imdbid,)))
         if torrent_indexers['limetorrents']:
-            lime_results = LimeTorrents.search(imdbid, term)
-            for i in lime_results:
-                if i not in results:
-                    results.append(i)
+            tasks.append(('LimeTorrents', urls['limetorrents'], LimeTorrents.search, (imdbid, term)))
         if torrent_indexers['extratorrent']:
-            extra_results = ExtraTorrent.search(imdbid, term)
-            for i in extra_results:
-                if i not in results:
-                    results.append(i)
+            tasks.append(('ExtraTorrent', urls['extratorrent'], ExtraTorrent.search, (imdbid, term)))
         if torrent_indexers['skytorrents']:
-            sky_results = SkyTorrents.search(imdbid, term)
-            for i in sky_results:
-                if i not in results:
-                    results.append(i)
+            tasks.append(('SkyTorrents', urls['skytorrents'], SkyTorrents.search, (imdbid, term)))
         if torrent_indexers['bitsnoop']:
-            bit_results = BitSnoop.search(imdbid, term)
-            for i in bit_results:
-                if i not in results:
-                    results.append(i)
+            tasks.append(('BitSnoop', urls['bitsnoop'], BitSnoop.search, (imdbid, term)))
         if torrent_indexers['torrentz2']:
-            torrentz_results = Torrentz2.search(imdbid, term)
-            for i in torrentz_results:
-                if i not in results:
-                    results.append(i)
+            tasks.append(('Torrentz2', urls['torrentz2'], Torrentz2.search, (imdbid, term)))
         if torrent_indexers['thepiratebay']:
-            tpb_results = ThePirateBay.search(imdbid, term)
-            for i in tpb_results:
-                if i not in results:
-                    results.append(i)
+            tasks.append(('ThePirateBay', urls['thepiratebay'], ThePirateBay.search, (imdbid, term)))
+
+        merger = ResultMerger()
+        for name, r in Fanout.run(tasks):
+            merger.add(name, r)
 
         self.imdbid = None
-        return results
+        return merger.results()
+
+    def _search_torznab(self, url_base, apikey, imdbid):
+        ''' Searches single TorzNab indexer for movie
+        url_base: str base url for all requests (https://indexer.com/)
+        apikey: str api key for indexer
+        imdbid: str imdb id #
+
+        Helper for search_all, run by Fanout.
 
-    def get_rss(self):
+        Returns list of dicts of search results
+        '''
+
+        return self.search_newznab(url_base, apikey, t='search', cat=2000, q=imdbid)
+
+    def get_rss(self, checkpoint=None):
         ''' Gets rss from all torznab providers and individual providers
+        checkpoint: object RssCheckpoint to skip items seen on previous syncs <optional>
 
         Returns list of dicts of latest movies
         '''
 
-        results = []
+        merger = ResultMerger()
 
-        results = self._get_rss()
+        merger.add('TorzNab', self._get_rss(checkpoint=checkpoint))
 
         torrent_indexers = core.CONFIG['Indexers']['Torrent']
 
+        feeds = []
         if torrent_indexers['rarbg']:
-            rarbg_results = Rarbg.get_rss()
-            for i in rarbg_results:
-                if i not in results:
-                    results.append(i)
+            feeds.append(('Rarbg', Torrent.urls['rarbg'], Rarbg.get_rss))
         if torrent_indexers['limetorrents']:
-            lime_results = LimeTorrents.get_rss()
-            for i in lime_results:
-                if i not in results:
-                    results.append(i)
+            feeds.append(('LimeTorrents', Torrent.urls['limetorrents'], LimeTorrents.get_rss))
         if torrent_indexers['extratorrent']:
-            extra_results = ExtraTorrent.get_rss()
-            for i in extra_results:
-                if i not in results:
-                    results.append(i)
+            feeds.append(('ExtraTorrent', Torrent.urls['extratorrent'], ExtraTorrent.get_rss))
         if torrent_indexers['torrentz2']:
-            torrentz_results = Torrentz2.get_rss()
-            for i in torrentz_results:
-                if i not in results:
-                    results.append(i)
+            feeds.append(('Torrentz2', Torrent.urls['torrentz2'], Torrentz2.get_rss))
 
-        return results
+        for name, url, get_rss in feeds:
+            if not CircuitBreaker.allow(url):
+                logging.info(u'{} is unavailable, skipping RSS.'.format(name))
+                continue
+            items = get_rss(validators=checkpoint.validators if checkpoint else None)
+            if checkpoint:
+                items = checkpoint.new_items(name, items)
+            merger.add(name, items)
+
+        return merger.results()
 
 
 class Rarbg(object):
     '''
-    This api is limited to once request every 2 seconds.
+    This api is limited to once request every 2 seconds. Requests are spaced
+        by the www.torrentapi.org entry in Network.ratelimits, see RateLimiter.
     '''
 
-    timeout = None
     token = None
 
+    # Searches for several movies can run at once. Only one thread may fetch
+    #   a new token at a time.
+    lock = threading.Lock()
+
     @staticmethod
-    def search(imdbid):
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
+    def check_token():
+        ''' Gets a token if one hasn't been retrieved yet
+
+        Returns Bool False if no token could be retrieved
+        '''
+
+        with Rarbg.lock:
+            if not Rarbg.token:
+                Rarbg.token = Rarbg.get_token()
+                if Rarbg.token is None:
+                    logging.error(u'Unable to get Rarbg token.')
+                    return False
+            return True
 
+    @staticmethod
+    def search(imdbid):
         logging.info(u'Searching Rarbg for {}.'.format(imdbid))
-        if Rarbg.timeout:
-            now = datetime.datetime.now()
-            while Rarbg.timeout > now:
-                time.sleep(1)
-                now = datetime.datetime.now()
-
-        if not Rarbg.token:
-            Rarbg.token = Rarbg.get_token()
-            if Rarbg.token is None:
-                logging.error(u'Unable to get Rarbg token.')
-                return []
 
-        url = u'https://www.torrentapi.org/pubapi_v2.php?token={}&mode=search&search_imdb={}&category=movies&format=json_extended&app_id=Watcher'.format(Rarbg.token, imdbid)
+        url = u'https://www.torrentapi.org/pubapi_v2.php?token={}&mode=search&search_imdb={}&category=movies&format=json_extended&app_id=Watcher'
 
-        request = Url.request(url)
+        # Checked before getting a token, cached responses don't need one
+        key = SearchCache.key(url.format('', imdbid))
+        response = SearchCache.get(key)
 
-        Rarbg.timeout = datetime.datetime.now() + datetime.timedelta(seconds=2)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.torrentapi.org') is True:
-                response = Proxy.bypass(request)
+            if response is None:
+                if not Rarbg.check_token():
+                    return []
+
+                request = Url.request(url.format(Rarbg.token, imdbid))
+                response = Url.open(request, proxy=True)
+                # errors such as an expired token come back as {"error": ...}
+                if 'error' not in json.loads(response):
+                    SearchCache.put(key, response)
             else:
-                response = Url.open(request)
+                logging.info(u'Using cached response for www.torrentapi.org.')
 
             results = json.loads(response).get('torrent_results')
             if results:
@@ -182,32 +194,21 @@ class Rarbg(object):
             return []
 
     @staticmethod
-    def get_rss():
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
+    def get_rss(validators=None):
         logging.info(u'Fetching latest RSS from Rarbg.')
-        if Rarbg.timeout:
-            now = datetime.datetime.now()
-            while Rarbg.timeout > now:
-                time.sleep(1)
-                now = datetime.datetime.now()
-
-        if not Rarbg.token:
-            Rarbg.token = Rarbg.get_token()
-            if Rarbg.token is None:
-                logging.error(u'Unable to get Rarbg token.')
-                return []
+        if not Rarbg.check_token():
+            return []
 
         url = u'https://www.torrentapi.org/pubapi_v2.php?token={}&mode=list&category=movies&format=json_extended&app_id=Watcher'.format(Rarbg.token)
 
         request = Url.request(url)
 
-        Rarbg.timeout = datetime.datetime.now() + datetime.timedelta(seconds=2)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.torrentapi.org') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = Url.open(request, conditional=True, proxy=True, pending=validators)
+
+            if response is None:
+                logging.info(u'Rarbg RSS not modified since last sync.')
+                return []
 
             results = json.loads(response).get('torrent_results')
             if results:
@@ -218,6 +219,9 @@ class Rarbg(object):
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception, e: # noqa
+            # not processed, so fetch the whole feed again next time
+            if validators is not None:
+                validators.pop(url, None)
             logging.error(u'Rarbg RSS fetch failed.', exc_info=True)
             return []
 
@@ -228,7 +232,7 @@ class Rarbg(object):
         request = Url.request(url)
 
         try:
-            response = Url.open(request)
+            response = Url.open(request, proxy=True)
             result = json.loads(response)
             token = result.get('token')
             return token
@@ -267,18 +271,13 @@ class LimeTorrents(object):
 
     @staticmethod
     def search(imdbid, term):
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         logging.info(u'Searching LimeTorrents for {}.'.format(term))
 
         url = u'https://www.limetorrents.cc/searchrss/{}'.format(term)
         request = Url.request(url)
 
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.limetorrents.cc') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = SearchCache.fetch(request, SearchCache.valid_xml)
 
             if response:
                 return LimeTorrents.parse(response, imdbid)
@@ -291,19 +290,14 @@ class LimeTorrents(object):
             return []
 
     @staticmethod
-    def get_rss():
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
+    def get_rss(validators=None):
         logging.info(u'Fetching latest RSS from LimeTorrents.')
 
         url = u'https://www.limetorrents.cc/rss/16/'
         request = Url.request(url)
 
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.limetorrents.cc') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = Url.open(request, conditional=True, proxy=True, pending=validators)
 
             if response:
                 return LimeTorrents.parse(response, None)
@@ -312,6 +306,9 @@ class LimeTorrents(object):
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception, e: # noqa
+            # not processed, so fetch the whole feed again next time
+            if validators is not None:
+                validators.pop(url, None)
             logging.error(u'LimeTorrent RSS fetch failed.', exc_info=True)
             return []
 
@@ -362,18 +359,13 @@ class ExtraTorrent(object):
 
     @staticmethod
     def search(imdbid, term):
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         logging.info(u'Searching ExtraTorrent for {}.'.format(term))
 
         url = u'https://www.extratorrent.cc/rss.xml?type=search&cid=4&search={}'.format(term)
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.extratorrent.cc') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = SearchCache.fetch(request, SearchCache.valid_xml)
 
             if response:
                 return ExtraTorrent.parse(response, imdbid)
@@ -386,19 +378,14 @@ class ExtraTorrent(object):
             return []
 
     @staticmethod
-    def get_rss():
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
+    def get_rss(validators=None):
         logging.info(u'Fetching latest RSS from ExtraTorrent.')
 
         url = u'https://www.extratorrent.cc/rss.xml?cid=4&type=today'
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.extratorrent.cc') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = Url.open(request, conditional=True, proxy=True, pending=validators)
 
             if response:
                 return ExtraTorrent.parse(response, None)
@@ -407,6 +394,9 @@ class ExtraTorrent(object):
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception, e: # noqa
+            # not processed, so fetch the whole feed again next time
+            if validators is not None:
+                validators.pop(url, None)
             logging.error(u'ExtraTorrent RSS fetch failed.', exc_info=True)
             return []
 
@@ -453,18 +443,13 @@ class SkyTorrents(object):
 
     @staticmethod
     def search(imdbid, term):
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         logging.info(u'Searching SkyTorrents for {}.'.format(term))
 
         url = u'https://www.skytorrents.in/rss/all/ed/1/{}'.format(term)
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.skytorrents.in') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = SearchCache.fetch(request, SearchCache.valid_xml)
 
             if response:
                 return SkyTorrents.parse(response, imdbid)
@@ -523,23 +508,18 @@ class BitSnoop(object):
 
     @staticmethod
     def search(imdbid, term):
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         logging.info(u'Searching BitSnoop for {}.'.format(term))
 
         url = u'https://www.bitsnoop.com/search/video/{}/c/d/1/?fmt=rss'.format(term)
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.bitsnoop.com') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = SearchCache.fetch(request, SearchCache.valid_xml)
 
-                if response:
-                    return BitSnoop.parse(response, imdbid)
-                else:
-                    return []
+            if response:
+                return BitSnoop.parse(response, imdbid)
+            else:
+                return []
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception, e: # noqa
@@ -547,19 +527,14 @@ class BitSnoop(object):
             return []
 
     @staticmethod
-    def get_rss():
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
+    def get_rss(validators=None):
         logging.info(u'Fetching latest RSS from BitSnoop.')
 
         url = u'https://www.bitsnoop.com/browse/video-movies/?sort=dt_reg&fmt=rss'
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.bitsnoop.com') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = Url.open(request, conditional=True, proxy=True, pending=validators)
 
             if response:
                 return BitSnoop.parse(response, None)
@@ -568,6 +543,9 @@ class BitSnoop(object):
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception, e: # noqa
+            # not processed, so fetch the whole feed again next time
+            if validators is not None:
+                validators.pop(url, None)
             logging.error(u'BitSnoop RSS fetch failed.', exc_info=True)
             return []
 
@@ -611,18 +589,13 @@ class Torrentz2(object):
 
     @staticmethod
     def search(imdbid, term):
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         logging.info(u'Searching Torrentz2 for {}.'.format(term))
 
         url = u'https://www.torrentz2.eu/feed?f={}'.format(term)
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.torrentz2.eu') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = SearchCache.fetch(request, SearchCache.valid_xml)
 
             if response:
                 return Torrentz2.parse(response, imdbid)
@@ -635,19 +608,14 @@ class Torrentz2(object):
             return []
 
     @staticmethod
-    def get_rss():
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
+    def get_rss(validators=None):
         logging.info(u'Fetching latest RSS from Torrentz2.')
 
         url = u'https://www.torrentz2.eu/feed?f=movies'
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.torrentz2.eu') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = Url.open(request, conditional=True, proxy=True, pending=validators)
 
             if response:
                 return Torrentz2.parse(response, None)
@@ -656,6 +624,9 @@ class Torrentz2(object):
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception, e: # noqa
+            # not processed, so fetch the whole feed again next time
+            if validators is not None:
+                validators.pop(url, None)
             logging.error(u'Torrentz2 RSS fetch failed.', exc_info=True)
             return []
 
@@ -704,8 +675,6 @@ class ThePirateBay(object):
 
     @staticmethod
     def search(imdbid, term):
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
         logging.info(u'Searching ThePirateBay for {}.'.format(term))
 
         url = u'https://www.thepiratebay.org/search/{}/0/99/200'.format(term)
@@ -713,10 +682,7 @@ class ThePirateBay(object):
         request = Url.request(url)
         request.add_header('Cookie', 'lw=s')
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.thepiratebay.org') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = SearchCache.fetch(request, ThePirateBay.valid)
 
             if response:
                 return ThePirateBay.parse(response, imdbid)
@@ -729,19 +695,14 @@ class ThePirateBay(object):
             return []
 
     @staticmethod
-    def get_rss():
-        proxy_enabled = core.CONFIG['Server']['Proxy']['enabled']
-
+    def get_rss(validators=None):
         logging.info(u'Fetching latest RSS from ThePirateBay.')
 
         url = u'https://www.thepiratebay.org/browse/201/0/3/0'
 
         request = Url.request(url)
         try:
-            if proxy_enabled and Proxy.whitelist('https://www.thepiratebay.org') is True:
-                response = Proxy.bypass(request)
-            else:
-                response = Url.open(request)
+            response = Url.open(request, conditional=True, proxy=True, pending=validators)
 
             if response:
                 return ThePirateBay.parse(response, None)
@@ -750,9 +711,22 @@ class ThePirateBay(object):
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception, e: # noqa
+            # not processed, so fetch the whole feed again next time
+            if validators is not None:
+                validators.pop(url, None)
             logging.error(u'ThePirateBay RSS fetch failed.', exc_info=True)
             return []
 
+    @staticmethod
+    def valid(html):
+        ''' Checks if response is a page of search results
+        html: str response body
+
+        Returns Bool
+        '''
+
+        return 'id="searchResult"' in html
+
     @staticmethod
     def parse(html, imdbid):
         logging.info(u'Parsing ThePirateBay results.')
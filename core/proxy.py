@@ -1,76 +1,173 @@
+import httplib
 import socket
+import ssl
+import threading
 import urllib2
 
 from lib import socks
 import core
+from core.httppool import PooledHTTPHandler, PooledHTTPSHandler
 import logging
 
 logging = logging.getLogger(__name__)
 
 
+class SocksHTTPConnection(httplib.HTTPConnection):
+    ''' HTTPConnection that connects through a SOCKS proxy
+
+    proxy_args is a tuple of arguments for socks.socksocket.setproxy()
+    '''
+
+    def __init__(self, host, proxy_args=None, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self.proxy_args = proxy_args
+
+    def connect(self):
+        self.sock = socks.socksocket()
+        self.sock.setproxy(*self.proxy_args)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect((self.host, self.port))
+
+
+class SocksHTTPSConnection(httplib.HTTPSConnection):
+    ''' HTTPSConnection that connects through a SOCKS proxy
+
+    proxy_args is a tuple of arguments for socks.socksocket.setproxy()
+    '''
+
+    def __init__(self, host, proxy_args=None, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self.proxy_args = proxy_args
+
+    def connect(self):
+        SocksHTTPConnection.connect.im_func(self)
+        if getattr(self, '_context', None):
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+        else:
+            self.sock = ssl.wrap_socket(self.sock, self.key_file, self.cert_file)
+
+
+class SocksHTTPHandler(PooledHTTPHandler):
+    ''' Sends http requests through a SOCKS proxy '''
+
+    def __init__(self, proxy_args):
+        PooledHTTPHandler.__init__(self)
+        self.proxy_args = proxy_args
+        self.pool_key = proxy_args
+
+    def http_open(self, req):
+        return self.pooled_open(self.connection, req)
+
+    def connection(self, host, **kwargs):
+        return SocksHTTPConnection(host, proxy_args=self.proxy_args, **kwargs)
+
+
+class SocksHTTPSHandler(PooledHTTPSHandler):
+    ''' Sends https requests through a SOCKS proxy '''
+
+    def __init__(self, proxy_args):
+        PooledHTTPSHandler.__init__(self)
+        self.proxy_args = proxy_args
+        self.pool_key = proxy_args
+
+    def connection(self, host, **kwargs):
+        return SocksHTTPSConnection(host, proxy_args=self.proxy_args, context=self._context, **kwargs)
+
+
 class Proxy(object):
+    ''' Chooses how each request reaches its host
+
+    Every request is sent with an opener picked for its url. Nothing global
+        is changed, so proxied and direct requests can run at the same time
+        from any thread.
+
+    The proxy opener is built once per proxy configuration and shared.
+        Openers and their handlers keep no per-request state. All openers
+        reuse keep-alive connections, see core.httppool.
+    '''
+
+    direct_opener = urllib2.build_opener(urllib2.ProxyHandler({}), PooledHTTPHandler(), PooledHTTPSHandler())
 
-    default_socket = urllib2.socket.socket
-    bypass_opener = urllib2.build_opener(urllib2.ProxyHandler({}))
-    proxy_socket = urllib2.socket.socket
-    on = False
+    # (tuple proxy settings, opener) of the last proxy opener built
+    proxy_opener = (None, None)
+    lock = threading.Lock()
 
     @staticmethod
-    def create():
-        if core.CONFIG['Server']['Proxy']['enabled']:
-            host = core.CONFIG['Server']['Proxy']['host']
-            port = core.CONFIG['Server']['Proxy']['port']
-            user = core.CONFIG['Server']['Proxy']['user'] or None
-            password = core.CONFIG['Server']['Proxy']['pass'] or None
-
-            if core.CONFIG['Server']['Proxy']['type'] == 'socks5':
-                logging.info(u'Creating socket for SOCKS5 proxy at {}:{}'.format(host, port))
-                socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, host, port, username=user, password=password)
-                Proxy.proxy_socket = socket.socket = socks.socksocket
-                socks.wrapmodule(urllib2)
-                Proxy.on = True
-            elif core.CONFIG['Server']['Proxy']['type'] == 'socks4':
-                logging.info(u'Creating socket for SOCKS4 proxy at {}:{}'.format(host, port))
-                socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS4, host, port, username=user, password=password)
-                Proxy.proxy_socket = socket.socket = socks.socksocket
-                Proxy.on = True
-            elif core.CONFIG['Server']['Proxy']['type'] == 'http(s)':
-                logging.info(u'Creating HTTP(S) proxy at {}:{}'.format(host, port))
-                protocol = host.split(':')[0]
-
-                proxies = {}
-
-                if user and password:
-                    url = u'{}:{}@{}:{}'.format(user, password, host, port)
-                else:
-                    url = u'{}:{}'.format(host, port)
-
-                proxies['http'] = url
-
-                if protocol == 'https':
-                    proxies['https'] = url
-                else:
-                    logging.warning(u'HTTP-only proxy. HTTPS traffic will not be tunneled through proxy.')
-
-                proxy = urllib2.ProxyHandler(proxies)
-                opener = urllib2.build_opener(proxy)
-                urllib2.install_opener(opener)
-                Proxy.on = True
-            else:
-                logging.warning(u'Invalid proxy type {}'.format(core.CONFIG['Server']['Proxy']['type']))
-                return
-        else:
-            return
+    def opener(url):
+        ''' Gets opener to send request to url with
+        url: str url of request
+
+        Returns the proxy opener if a proxy is enabled and url is not in the
+            whitelist. Otherwise returns an opener that connects directly.
+
+        Returns object urllib2.OpenerDirector
+        '''
+
+        if not core.CONFIG['Server']['Proxy']['enabled'] or Proxy.whitelist(url):
+            return Proxy.direct_opener
+
+        return Proxy._proxy_opener() or Proxy.direct_opener
 
     @staticmethod
-    def destroy():
-        # restore socket
-        urllib2.socket.socket = Proxy.default_socket
-        # disable http/s proxies
-        proxy_handler = urllib2.ProxyHandler({})
-        opener = urllib2.build_opener(proxy_handler)
-        urllib2.install_opener(opener)
-        Proxy.on = False
+    def _proxy_opener():
+        ''' Gets opener for configured proxy
+
+        Builds a new opener if proxy settings have changed since the last one.
+
+        Returns object urllib2.OpenerDirector, or None if proxy type is invalid
+        '''
+
+        conf = core.CONFIG['Server']['Proxy']
+        settings = (conf['type'], conf['host'], conf['port'], conf['user'], conf['pass'])
+
+        with Proxy.lock:
+            if Proxy.proxy_opener[0] != settings:
+                Proxy.proxy_opener = (settings, Proxy._build(*settings))
+            return Proxy.proxy_opener[1]
+
+    @staticmethod
+    def _build(kind, host, port, user, password):
+        ''' Builds opener for proxy
+        kind: str proxy type 'socks5', 'socks4', or 'http(s)'
+        host: str proxy host
+        port: int proxy port
+        user: str proxy user name
+        password: str proxy password
+
+        Returns object urllib2.OpenerDirector, or None if kind is invalid
+        '''
+
+        user = user or None
+        password = password or None
+
+        if kind in ('socks5', 'socks4'):
+            logging.info(u'Creating opener for {} proxy at {}:{}'.format(kind.upper(), host, port))
+            proxy_type = socks.PROXY_TYPE_SOCKS5 if kind == 'socks5' else socks.PROXY_TYPE_SOCKS4
+            proxy_args = (proxy_type, host, int(port), True, user, password)
+            return urllib2.build_opener(urllib2.ProxyHandler({}), SocksHTTPHandler(proxy_args), SocksHTTPSHandler(proxy_args))
+        elif kind == 'http(s)':
+            logging.info(u'Creating opener for HTTP(S) proxy at {}:{}'.format(host, port))
+            protocol = host.split(':')[0]
+
+            proxies = {}
+
+            if user and password:
+                url = u'{}:{}@{}:{}'.format(user, password, host, port)
+            else:
+                url = u'{}:{}'.format(host, port)
+
+            proxies['http'] = url
+
+            if protocol == 'https':
+                proxies['https'] = url
+            else:
+                logging.warning(u'HTTP-only proxy. HTTPS traffic will not be tunneled through proxy.')
+
+            return urllib2.build_opener(urllib2.ProxyHandler(proxies), PooledHTTPHandler(), PooledHTTPSHandler())
+        else:
+            logging.warning(u'Invalid proxy type {}'.format(kind))
+            return None
 
     @staticmethod
     def whitelist(url):
@@ -82,35 +179,10 @@ class Proxy(object):
         '''
         whitelist = core.CONFIG['Server']['Proxy']['whitelist'].split(',')
 
-        if len(whitelist) == [u'']:
-            return False
-
         for i in whitelist:
-            if url.startswith(i.strip()):
+            if i.strip() and url.startswith(i.strip()):
                 logging.info(u'Bypassing proxy for whitelist url {}'.format(url))
                 return True
             else:
                 continue
         return False
-
-    @staticmethod
-    def bypass(request):
-        ''' Temporaily turns off proxy for single request.
-        request: urllib2 request object
-
-        Restores the default urllib2 socket and uses the default opener to send request.
-        When finished restores the proxy socket. If using an http/s proxy the socket is
-            restored to the original, so it never changes anyway.
-
-        Should always be inside a try/except block just like any url request.
-
-        Returns object urllib2 response
-        '''
-
-        urllib2.socket.socket = Proxy.default_socket
-
-        response = Proxy.bypass_opener.open(request)
-
-        urllib2.socket.socket = Proxy.proxy_socket
-
-        return response
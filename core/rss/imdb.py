@@ -7,7 +7,6 @@ import logging
 import os
 import urllib2
 import xml.etree.cElementTree as ET
-import time
 
 logging = logging.getLogger(__name__)
 
@@ -33,13 +32,17 @@ class ImdbRss(object):
             logging.info(u'Syncing rss IMDB watchlist {}'.format(url))
             request = Url.request(url)
             try:
-                response = Url.open(request)
+                response = Url.open(request, conditional=True)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except Exception, e: # noqa
                 logging.error(u'IMDB rss request.', exc_info=True)
                 return None
 
+            if response is None:
+                logging.info(u'IMDB watchlist {} not modified since last sync.'.format(url))
+                return None
+
             movies = self.parse_xml(response)
 
         else:
@@ -98,7 +101,8 @@ class ImdbRss(object):
 
         Checks if movies are already in library and ignores.
 
-        Executes ajax.add_wanted_movie() for each new imdbid
+        Executes ajax.add_movie() for each new imdbid, then searches them
+            with ajax.search_added()
 
         Does not return
         '''
@@ -138,6 +142,7 @@ class ImdbRss(object):
         movies_to_add = [i for i in new_rss_movies if i not in existing_movies]
 
         # do quick-add procedure
+        added = []
         for imdbid in movies_to_add:
             movie_info = self.tmdb._search_imdbid(imdbid)[0]
             if not movie_info:
@@ -145,8 +150,11 @@ class ImdbRss(object):
                 continue
             logging.info(u'Adding movie {} {} from imdb watchlist.'.format(title, imdbid))
             movie_info['quality'] = 'Default'
-            self.ajax.add_wanted_movie(json.dumps(movie_info))
-            time.sleep(1)
+            if json.loads(self.ajax.add_movie(json.dumps(movie_info), search=False))['response']:
+                added.append(imdbid)
+
+        # searched a few at a time instead of a thread per movie
+        self.ajax.search_added(added)
 
         logging.info(u'Storing last synced date.')
         with open(data_file, 'w') as f:
@@ -4,7 +4,6 @@ from core.helpers import Url
 import json
 import logging
 import urllib2
-import time
 
 logging = logging.getLogger(__name__)
 
@@ -30,7 +29,10 @@ class PopularMoviesFeed(object):
         request = Url.request('https://s3.amazonaws.com/popular-movies/movies.json',
                               headers={'User-Agent': 'Mozilla/5.0'})
         try:
-            response = Url.open(request)
+            response = Url.open(request, conditional=True)
+            if response is None:
+                logging.info(u'Popular movies feed not modified since last sync.')
+                return None
             movies = json.loads(response)
         except (SystemExit, KeyboardInterrupt):
             raise
@@ -54,7 +56,8 @@ class PopularMoviesFeed(object):
 
         Checks if movies are already in library and ignores.
 
-        Executes ajax.add_wanted_movie() for each new imdbid
+        Executes ajax.add_movie() for each new imdbid, then searches them
+            with ajax.search_added()
 
         Does not return
         '''
@@ -76,11 +79,15 @@ class PopularMoviesFeed(object):
         movies_to_add = [i for i in new_sync_movies if i not in existing_movies]
 
         # do quick-add procedure
+        added = []
         for imdbid in movies_to_add:
             movie_info = self.tmdb._search_imdbid(imdbid)[0]
             if not movie_info:
                 logging.warning(u'{} not found on TMDB. Cannot add.'.format(imdbid))
                 continue
             movie_info['quality'] = 'Default'
-            self.ajax.add_wanted_movie(json.dumps(movie_info))
-            time.sleep(1)
+            if json.loads(self.ajax.add_movie(json.dumps(movie_info), search=False))['response']:
+                added.append(imdbid)
+
+        # searched a few at a time instead of a thread per movie
+        self.ajax.search_added(added)
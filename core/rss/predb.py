@@ -69,6 +69,10 @@ class PreDB(object):
         ''' Searches predb rss for title_year
         :param title_year: str movie title and year 'Black Swan 2010'
 
+        Results are requested conditionally. If predb.me's results have not
+            changed since this movie was last checked they still did not match,
+            so nothing is downloaded and None is returned.
+
         Returns list of found rss entries or None if not found.
         '''
 
@@ -79,7 +83,10 @@ class PreDB(object):
         request = Url.request(url)
 
         try:
-            response = Url.open(request)
+            response = Url.open(request, conditional=True)
+            if response is None:
+                logging.info(u'Predb.me results for {} not modified since last check.'.format(title_year))
+                return None
             results_xml = response.replace('&', '%26')
             items = self.parse_predb_xml(results_xml)
             return items
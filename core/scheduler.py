@@ -5,7 +5,7 @@ import cherrypy
 import core
 from core.notification import Notification
 
-from core import searcher, version
+from core import dbbackup, searcher, sqldb, version
 from core.rss import imdb, popularmovies
 from core.cp_plugins import taskscheduler
 
@@ -208,3 +208,77 @@ class PopularMoviesSync(object):
 
         popular_feed.get_feed()
         return
+
+
+class DatabaseBackup(object):
+
+    @staticmethod
+    def create():
+        interval = core.CONFIG['Database']['backupfrequency'] * 3600
+
+        now = datetime.datetime.now()
+        hr = now.hour
+        min = now.minute + 10
+
+        if core.CONFIG['Database']['backupenabled']:
+            auto_start = True
+        else:
+            auto_start = False
+
+        taskscheduler.ScheduledTask(hr, min, interval, DatabaseBackup.backup,
+                                    auto_start=auto_start)
+        return
+
+    @staticmethod
+    def backup():
+        logging.info(u'Running automatic database backup.')
+
+        dbbackup.Backup().snapshot()
+        return
+
+
+class DatabaseMaintenance(object):
+
+    @staticmethod
+    def create():
+        interval = core.CONFIG['Database']['maintenancefrequency'] * 3600
+
+        now = datetime.datetime.now()
+        hr = now.hour
+        min = now.minute + 20
+
+        if core.CONFIG['Database']['maintenanceenabled']:
+            auto_start = True
+        else:
+            auto_start = False
+
+        taskscheduler.ScheduledTask(hr, min, interval, DatabaseMaintenance.maintenance,
+                                    auto_start=auto_start)
+        return
+
+    @staticmethod
+    def maintenance():
+        logging.info(u'Running automatic database maintenance.')
+
+        sql = sqldb.SQL()
+        days = core.CONFIG['Database']['prunedays']
+
+        size = sql.get_size()
+
+        pruned = sql.prune_search_results(days)
+        if pruned is False:
+            logging.error(u'Unable to prune search results.')
+            pruned = 0
+
+        if not sql.optimize():
+            notif = {'type': 'error',
+                     'closeButton': 'true',
+                     'title': 'Database Integrity Check Failed',
+                     'body': 'See log for details. Restore a backup from the db folder if errors persist.',
+                     'params': '{closeButton: true, timeOut: 0, extendedTimeOut: 0}'
+                     }
+            Notification.add(notif)
+
+        reclaimed = size - sql.get_size()
+        logging.info(u'Database maintenance finished. Pruned {} search results, reclaimed {} KB.'.format(pruned, reclaimed / 1024))
+        return
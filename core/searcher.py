@@ -1,14 +1,105 @@
 import datetime
 import logging
+import Queue
+import re
+import threading
+import time
 
 import core
-from core import scoreresults, snatcher, sqldb, updatestatus, proxy
+from core import scoreresults, snatcher, sqldb, updatestatus
 from core.providers import torrent, newznab
+from core.providers.base import RssCheckpoint
 from core.rss import predb
-from fuzzywuzzy import fuzz
+from fuzzywuzzy import fuzz, utils
 
 logging = logging.getLogger(__name__)
 
+# Per-movie locks so one movie is never searched by two threads at once. Removed when
+# no thread is searching or waiting to search the movie. {imdbid: [Lock, int users]}
+_search_locks = {}
+_search_locks_lock = threading.Lock()
+
+
+class RssIndex(object):
+    ''' Per-sync lookup tables for matching rss items to movies
+
+    NewzNab items carry an imdbid and are simply grouped by it.
+
+    Torrent items only have a release name, so they are grouped by every
+        four-digit number in the name and then by the tokens of the name. A
+        movie is only fuzzy-matched against items that contain its year and
+        share at least one title token, instead of every item in the feed.
+    '''
+
+    years = re.compile(r'(?=(\d{4}))')
+
+    def __init__(self, newznab_results, torrent_results):
+        self.torrents = torrent_results
+
+        # {imdbid: [results]}
+        self.newznab = {}
+        for result in newznab_results:
+            self.newznab.setdefault(result['imdbid'], []).append(result)
+
+        # {year: {token: set(indexes into self.torrents)}}
+        self.torrent_index = {}
+        for idx, result in enumerate(torrent_results):
+            name = result['title'] or u''
+            tokens = self.tokens(name)
+            for year in set(self.years.findall(name)):
+                by_token = self.torrent_index.setdefault(year, {})
+                for token in tokens:
+                    by_token.setdefault(token, set()).add(idx)
+        return
+
+    @staticmethod
+    def tokens(title):
+        ''' Splits title into the tokens fuzzy matching compares
+        title: str title of movie or release
+
+        Returns set of str
+        '''
+
+        return set(utils.full_process(title, force_ascii=True).split())
+
+    def newznab_results(self, imdbid):
+        ''' Gets newznab items for movie
+        imdbid: str imdb identification number (tt123456)
+
+        Returns list of dicts
+        '''
+
+        return self.newznab.get(imdbid, [])
+
+    def torrent_candidates(self, title, year):
+        ''' Gets torrent items that could match movie
+        title: str title of movie
+        year: str year of movie release
+
+        Falls back to every item if year is not a four-digit year, since the
+            year check in Searcher._match_torrent_name is a plain substring test.
+
+        Returns list of dicts in feed order
+        '''
+
+        year = u'{}'.format(year)
+        if not re.match(r'^\d{4}$', year):
+            return self.torrents
+
+        by_token = self.torrent_index.get(year)
+        if not by_token:
+            return []
+
+        tokens = self.tokens(title)
+        if tokens:
+            matches = set()
+            for token in tokens:
+                matches.update(by_token.get(token, ()))
+        else:
+            matches = set.union(*by_token.values())
+
+        return [self.torrents[i] for i in sorted(matches)]
+
 
 class Searcher():
 
@@ -49,10 +140,8 @@ class Searcher():
         now = datetime.datetime.today().replace(second=0, microsecond=0)
         core.NEXT_SEARCH = now + datetime.timedelta(0, interval)
 
-        today = datetime.date.today()
         keepsearching = core.CONFIG['Search']['keepsearching']
         keepsearchingdays = core.CONFIG['Search']['keepsearchingdays']
-        keepsearchingdelta = datetime.timedelta(days=keepsearchingdays)
         auto_grab = core.CONFIG['Search']['autograb']
 
         self.predb.check_all()
@@ -69,18 +158,7 @@ class Searcher():
         if backlog_movies:
             logging.info('Performing backlog search for {} movies.'.format(len(backlog_movies)))
             logging.debug('Backlog movies: {}'.format(backlog_movies))
-            for movie in backlog_movies:
-                if movie['predb'] != u'found':
-                    continue
-                imdbid = movie['imdbid']
-                title = movie['title']
-                year = movie['year']
-                quality = movie['quality']
-                status = movie['status']
-
-                logging.info('Executing backlog search for {} {}.'.format(title, year))
-                self.search(imdbid, title, year, quality)
-                continue
+            self.backlog_search([i for i in backlog_movies if i['predb'] == u'found'])
 
         rss_movies = self._get_rss_movies(movies)
 
@@ -95,38 +173,87 @@ class Searcher():
             logging.info(u'############ Running automatic snatcher ############')
             keepsearchingscore = core.CONFIG['Search']['keepsearchingscore']
             # In case we found something we'll check this again.
-            movies = self.sql.get_user_movies()
-            if not movies:
+            movies = self.sql.get_movies_by_status(u'Found')
+            if movies is False:
                 return False
+            if keepsearching is True:
+                movies += self.sql.get_movies_finished_within(keepsearchingdays) or []
             for movie in movies:
                 status = movie['status']
-                if status == 'Disabled':
-                    continue
-                imdbid = movie['imdbid']
                 title = movie['title']
                 year = movie['year']
-                quality = movie['quality']
 
                 if status == u'Found':
                     logging.info(u'{} status is Found. Running automatic snatcher.'.format(title))
                     self.snatcher.auto_grab(movie)
                     continue
 
-                if status == u'Finished' and keepsearching is True:
+                if status == u'Finished':
                     finished_date = movie['finished_date']
-                    finished_date_obj = datetime.datetime.strptime(finished_date, '%Y-%m-%d').date()
-                    if finished_date_obj + keepsearchingdelta >= today:
-                        minscore = movie['finished_score'] + keepsearchingscore
-                        logging.info(u'{} {} was marked Finished on {}. Checking for a better release (min score {}).'.format(title, year, finished_date, minscore))
-                        self.snatcher.auto_grab(movie, minscore=minscore)
-                        continue
-                    else:
-                        continue
-                else:
+                    minscore = movie['finished_score'] + keepsearchingscore
+                    logging.info(u'{} {} was marked Finished on {}. Checking for a better release (min score {}).'.format(title, year, finished_date, minscore))
+                    self.snatcher.auto_grab(movie, minscore=minscore)
                     continue
         logging.info(u'######### Automatic search/snatch complete #########')
         return
 
+    def backlog_search(self, movies, search=None):
+        ''' Executes backlog search for many movies at once
+        movies: list of dicts of movies to search for
+        search: function that takes dict movie to run instead of self.search <optional>
+
+        Runs self.search for Network.backlogworkers movies at a time. Logs
+            progress and throughput as each movie finishes.
+
+        Does not return
+        '''
+
+        if not movies:
+            return
+
+        workers = min(max(core.CONFIG['Network']['backlogworkers'], 1), len(movies))
+        logging.info(u'Starting backlog search for {} movies with {} workers.'.format(len(movies), workers))
+
+        queue = Queue.Queue()
+        for movie in movies:
+            queue.put(movie)
+
+        progress = {'done': 0}
+        progress_lock = threading.Lock()
+        start = time.time()
+
+        def work():
+            while True:
+                try:
+                    movie = queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                logging.info(u'Executing backlog search for {} {}.'.format(movie['title'], movie['year']))
+                try:
+                    if search:
+                        search(movie)
+                    else:
+                        self.search(movie['imdbid'], movie['title'], movie['year'], movie['quality'])
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except Exception, e: # noqa
+                    logging.error(u'Backlog search for {} failed.'.format(movie['imdbid']), exc_info=True)
+
+                with progress_lock:
+                    progress['done'] += 1
+                    minutes = (time.time() - start) / 60
+                    logging.info(u'Backlog search {} of {} complete, {:.1f} movies/min.'.format(progress['done'], len(movies), progress['done'] / minutes))
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        logging.info(u'Backlog search for {} movies finished in {:.1f} minutes.'.format(len(movies), (time.time() - start) / 60))
+        return
+
     def search(self, imdbid, title, year, quality):
         ''' Executes backlog search for required movies
         imdbid: str imdb identification number
@@ -146,22 +273,52 @@ class Searcher():
 
         Finally stores results in SEARCHRESULTS
 
+        Safe to call from several threads. Searches for the same movie run one
+            at a time.
+
         Returns Bool if movie is found.
         '''
 
-        proxy.Proxy.create()
+        with _search_locks_lock:
+            entry = _search_locks.setdefault(imdbid, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                return self._search(imdbid, title, year, quality)
+        finally:
+            with _search_locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del _search_locks[imdbid]
+
+    def _search(self, imdbid, title, year, quality):
+        ''' Executes backlog search for single movie
+        imdbid: str imdb identification number
+        title: str movie title
+        year: str year of movie release
+        quality: str name of quality profile.
+
+        Helper for self.search(), see it for details.
+
+        Providers and scoring keep per-search state, so each search uses its own instances.
+
+        Returns Bool if movie is found.
+        '''
+
+        nn = newznab.NewzNab()
+        torrent_search = torrent.Torrent()
+        score = scoreresults.ScoreResults()
 
         results = []
 
         if core.CONFIG['Downloader']['Sources']['usenetenabled']:
-            for i in self.nn.search_all(imdbid):
+            for i in nn.search_all(imdbid):
                 results.append(i)
         if core.CONFIG['Downloader']['Sources']['torrentenabled']:
-            for i in self.torrent.search_all(imdbid, title, year):
+            for i in torrent_search.search_all(imdbid, title, year):
                 results.append(i)
 
-        proxy.Proxy.destroy()
-
         old_results = [dict(r) for r in self.sql.get_search_results(imdbid, quality)]
 
         for old in old_results:
@@ -184,7 +341,7 @@ class Searcher():
             logging.info('0 results found.')
             return True
 
-        scored_results = self.score.score(results, imdbid=imdbid)
+        scored_results = score.score(results, imdbid=imdbid)
 
         if len(scored_results) == 0:
             return True
@@ -196,16 +353,21 @@ class Searcher():
                 if result['guid'] in marked_results:
                     result['status'] = marked_results[result['guid']]
 
-        if not self.store_results(scored_results, imdbid, backlog=True):
-            logging.error(u'Unable to store search results for {}'.format(imdbid))
-            return False
-
-        if not self.update.movie_status(imdbid):
-            logging.error(u'Unable to update movie status for {}'.format(imdbid))
-            return False
-
-        if not self.sql.update('MOVIES', 'backlog', '1', 'imdbid', imdbid):
-            logging.error(u'Unable to flag backlog search as complete for {}'.format(imdbid))
+        # Purge, write, status update and backlog flag are committed together
+        try:
+            with self.sql.transaction():
+                if not self.store_results(scored_results, imdbid, backlog=True):
+                    raise Exception(u'Unable to store search results for {}'.format(imdbid))
+
+                if not self.update.movie_status(imdbid):
+                    raise Exception(u'Unable to update movie status for {}'.format(imdbid))
+
+                if not self.sql.update('MOVIES', 'backlog', '1', 'imdbid', imdbid):
+                    raise Exception(u'Unable to flag backlog search as complete for {}'.format(imdbid))
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception, e: # noqa
+            logging.error(u'Storing backlog search results for {}.'.format(imdbid), exc_info=True)
             return False
 
         return True
@@ -221,49 +383,60 @@ class Searcher():
         Only stores new results. If you need to update scores or old results
             force a backlog search.
 
-        Finally stores results in SEARCHRESULTS
+        Feed items seen on a previous sync are skipped, see RssCheckpoint. The
+            new checkpoints are only saved once this sync's results are stored.
 
-        Does not return
+        Finally stores results in SEARCHRESULTS and updates the status of every
+            movie with new results in a single pass.
+
+        Returns Bool
         '''
         newznab_results = []
         torrent_results = []
 
-        proxy.Proxy.create()
+        checkpoint = RssCheckpoint()
 
         if core.CONFIG['Downloader']['Sources']['usenetenabled']:
-            newznab_results = self.nn.get_rss()
+            newznab_results = self.nn.get_rss(checkpoint=checkpoint)
         if core.CONFIG['Downloader']['Sources']['torrentenabled']:
-            torrent_results = self.torrent.get_rss()
+            torrent_results = self.torrent.get_rss(checkpoint=checkpoint)
 
-        proxy.Proxy.destroy()
+        index = RssIndex(newznab_results, torrent_results)
+
+        # {imdbid: [matching results]}
+        matches = {}
 
         for movie in movies:
             imdbid = movie['imdbid']
             title = movie['title']
             year = movie['year']
 
-            nn_found = [i for i in newznab_results if i['imdbid'] == imdbid]
+            nn_found = index.newznab_results(imdbid)
 
-            tor_found = [i for i in torrent_results if
+            # One release can match several movies, so each movie gets its own copy
+            tor_found = [dict(i, imdbid=imdbid) for i in index.torrent_candidates(title, year) if
                          self._match_torrent_name(title, year, i['title'])]
-            for idx, result in enumerate(tor_found):
-                result['imdbid'] = imdbid
-                tor_found[idx] = result
 
-            results = nn_found + tor_found
+            if nn_found or tor_found:
+                matches[imdbid] = (movie, nn_found + tor_found)
 
-            if not results:
-                continue
+        if not matches:
+            return checkpoint.save()
 
-            # Ignore results we've already stored
-            old_results = [dict(r) for r in self.sql.get_search_results(imdbid)]
-            new_results = []
-            for res in results:
-                guid = res['guid']
-                if all(guid != i['guid'] for i in old_results):
-                    new_results.append(res)
-                else:
-                    continue
+        # Ignore results we've already stored
+        stored = self.sql.get_stored_guids(r['guid'] for movie, results in matches.itervalues() for r in results)
+        if stored is False:
+            logging.error(u'Unable to check RSS results against stored results.')
+            return False
+
+        # {imdbid: [scored results]}
+        found = {}
+
+        for imdbid, (movie, results) in matches.iteritems():
+            title = movie['title']
+            year = movie['year']
+
+            new_results = [r for r in results if (imdbid, r['guid']) not in stored]
 
             logging.info('Found {} new results for {} {}.'.format(len(new_results), title, year))
 
@@ -276,14 +449,27 @@ class Searcher():
             if len(scored_results) == 0:
                 continue
 
-            if not self.store_results(scored_results, imdbid):
-                return False
+            found[imdbid] = scored_results
 
-            if not self.update.movie_status(imdbid):
-                logging.info(u'No acceptable results found for {}'.format(imdbid))
-                return False
+        if not found:
+            return checkpoint.save()
 
-        return True
+        # New results and the resulting status changes are committed together
+        try:
+            with self.sql.transaction():
+                for imdbid, scored_results in found.iteritems():
+                    if not self.store_results(scored_results, imdbid):
+                        raise Exception(u'Unable to store search results for {}'.format(imdbid))
+
+                if not self.update.movie_statuses(found.keys()):
+                    raise Exception(u'Unable to update movie statuses.')
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception, e: # noqa
+            logging.error(u'Storing RSS results.', exc_info=True)
+            return False
+
+        return checkpoint.save()
 
     def remove_inactive(self, results):
         ''' Removes results from indexers no longer enabled
@@ -414,10 +600,9 @@ class Searcher():
 
         Returns list of dicts of movies that require backlog search
         '''
-        today = datetime.date.today()
         keepsearching = core.CONFIG['Search']['keepsearching']
         keepsearchingdays = core.CONFIG['Search']['keepsearchingdays']
-        keepsearchingdelta = datetime.timedelta(days=keepsearchingdays)
+        earliest_finished = self.sql.today() - keepsearchingdays
 
         rss_movies = []
 
@@ -435,8 +620,7 @@ class Searcher():
                 rss_movies.append(i)
                 logging.info('{} {} is {}. Will look for new releases in RSS feed.'.format(title, year, status))
             if status == 'Finished' and keepsearching is True:
-                finished_date_obj = datetime.datetime.strptime(i['finished_date'], '%Y-%m-%d').date()
-                if finished_date_obj + keepsearchingdelta >= today:
+                if i['finished_day'] is not None and i['finished_day'] >= earliest_finished:
                     logging.info(u'{} {} was marked Finished on {}, will keep checking RSS feed for new releases.'.format(title, year, i['finished_date']))
                     rss_movies.append(i)
                 continue
@@ -1,5 +1,4 @@
 import logging
-from datetime import datetime
 import urllib2
 import core
 from core import plugins, sqldb, updatestatus
@@ -41,62 +40,65 @@ class Snatcher():
             quality = movie['quality']
             year = movie['year']
             title = movie['title']
-            release_date = movie['release_date']
+            release_day = movie.get('release_day')
+            # Movies passed straight from add_wanted_movie have no day columns yet
+            if release_day is None:
+                release_day = sqldb.SQL.day_number(movie.get('release_date'))
         except Exception, e: #noqa
             logging.error('Invalid movie data.', exc_info=True)
 
-        search_results = self.sql.get_search_results(imdbid, quality)
-        if not search_results:
-            logging.warning(u'Unable to automatically grab {}, no results.'.format(imdbid))
-            return False
-
-        # Filter out any results we don't want to grab
-        search_results = [i for i in search_results if i['type'] != 'import']
-        if not core.CONFIG['Downloader']['Sources']['usenetenabled']:
-            search_results = [i for i in search_results if i['type'] != 'nzb']
-        if not core.CONFIG['Downloader']['Sources']['torrentenabled']:
-            search_results = [i for i in search_results if i['type'] not in ['torrent', 'magnet']]
+        # Only consider results we can send to an enabled downloader
+        types = []
+        if core.CONFIG['Downloader']['Sources']['usenetenabled']:
+            types.append('nzb')
+        if core.CONFIG['Downloader']['Sources']['torrentenabled']:
+            types += ['torrent', 'magnet']
 
-        if not search_results:
+        if not types or not self.sql.count_search_results(imdbid, types=types):
             logging.warning(u'Unable to automatically grab {}, no results for enabled downloader.'.format(imdbid))
             return False
 
         # Check if we are past the 'waitdays'
-        today = datetime.today()
-        release_weeks_old = (today - datetime.strptime(release_date, '%Y-%m-%d')).days / 7
+        today = self.sql.today()
+
+        if release_day is None:
+            logging.info('{} has no release date, grabbing immediately.'.format(title))
+        else:
+            release_weeks_old = (today - release_day) / 7
 
-        if core.CONFIG['Search']['skipwait'] and release_weeks_old < core.CONFIG['Search']['skipwaitweeks']:
-            logging.info('{} released {} weeks ago, checking age of search results.'.format(title, release_weeks_old))
-            wait_days = core.CONFIG['Search']['waitdays']
+            if core.CONFIG['Search']['skipwait'] and release_weeks_old < core.CONFIG['Search']['skipwaitweeks']:
+                logging.info('{} released {} weeks ago, checking age of search results.'.format(title, release_weeks_old))
+                wait_days = core.CONFIG['Search']['waitdays']
 
-            earliest_found = min([x['date_found'] for x in search_results])
-            date_found = datetime.strptime(earliest_found, '%Y-%m-%d')
+                earliest_found = self.sql.get_earliest_found(imdbid, types=types)
 
-            if (today - date_found).days < wait_days:
-                logging.info(u'Earliest found result for {} is {}, waiting {} days to grab best result.'.format(imdbid, date_found, wait_days))
-                return False
-        else:
-            logging.info('{} released {} weeks ago, grabbing immediately.'.format(title, release_weeks_old))
+                if earliest_found is not None and today - earliest_found < wait_days:
+                    logging.info(u'Earliest found result for {} is {} days old, waiting {} days to grab best result.'.format(imdbid, today - earliest_found, wait_days))
+                    return False
+            else:
+                logging.info('{} released {} weeks ago, grabbing immediately.'.format(title, release_weeks_old))
 
-        # Since seach_results comes back in order of score we can go
-        # through in order until we find the first Available result
-        # and grab it.
+        # Results come back in order of score, so the best result that isn't Bad
+        # is either the one to grab or has already been grabbed.
         logging.info(u'Selecting best result for {}'.format(imdbid))
-        for result in search_results:
-            result = dict(result)
-            status = result['status']
-            result['year'] = year
-
-            if result['status'] == u'Available' and result['score'] > minscore:
-                self.snatch(result)
-                return True
-            # if doing a re-search, if top ranked result is Snatched we have nothing to do.
-            if status in ['Snatched', 'Finished']:
-                logging.info(u'Top-scoring release for {} has already been snatched.'.format(imdbid))
-                return False
-
-        logging.warning(u'Unable to automatically grab {}, no Available results.'.format(imdbid))
-        return False
+        result = self.sql.get_best_result(imdbid, quality, types=types)
+
+        if result is None:
+            logging.warning(u'Unable to automatically grab {}, no Available results.'.format(imdbid))
+            return False
+
+        # if doing a re-search, if top ranked result is Snatched we have nothing to do.
+        if result['status'] in ['Snatched', 'Finished']:
+            logging.info(u'Top-scoring release for {} has already been snatched.'.format(imdbid))
+            return False
+
+        if result['score'] <= minscore:
+            logging.warning(u'Unable to automatically grab {}, no Available results above score {}.'.format(imdbid, minscore))
+            return False
+
+        result['year'] = year
+        self.snatch(result)
+        return True
 
     def snatch(self, data):
         '''
@@ -316,19 +318,27 @@ class Snatcher():
     def update_status_snatched(self, guid, imdbid):
         '''
         Updates MOVIES, SEARCHRESULTS, and MARKEDRESULTS to 'Snatched'
-        Returns Bool on success/fail
-        '''
 
-        if not self.update.searchresults(guid, 'Snatched'):
-            logging.error('Unable to update search result status to Snatched.')
-            return False
+        All three tables are updated in one transaction, so either every
+            status changes or none do.
 
-        if not self.update.markedresults(guid, 'Snatched', imdbid=imdbid):
-            logging.error('Unable to store marked search result as Snatched.')
-            return False
+        Returns Bool on success/fail
+        '''
 
-        if not self.update.movie_status(imdbid):
-            logging.error('Unable to update movie status to Snatched.')
+        try:
+            with self.sql.transaction():
+                if not self.update.searchresults(guid, 'Snatched'):
+                    raise Exception('Unable to update search result status to Snatched.')
+
+                if not self.update.markedresults(guid, 'Snatched', imdbid=imdbid):
+                    raise Exception('Unable to store marked search result as Snatched.')
+
+                if not self.update.movie_status(imdbid):
+                    raise Exception('Unable to update movie status to Snatched.')
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception, e: # noqa
+            logging.error(u'Marking {} as Snatched.'.format(guid.split('&')[0]), exc_info=True)
             return False
 
         return True
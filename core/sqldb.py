@@ -1,14 +1,48 @@
+import contextlib
 import core
 import datetime
 import logging
 import time
 import os
-import shutil
+import re
+import sys
+import threading
 
-from core.helpers import Comparisons
+from core import dbbackup
 from sqlalchemy import *
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 logging = logging.getLogger(__name__)
+slow_log = logging.getChild('slow')
+
+
+# Engines are shared by every SQL instance. {db_file: engine}
+_engines = {}
+_engine_lock = threading.Lock()
+
+# Holds the connection of the transaction open in each thread. See SQL.transaction()
+_local = threading.local()
+
+# Read-through cache of MOVIES shared by every SQL instance. See SQL._movie_cache()
+#   cache: {'movies': [dicts ordered by title], 'imdbid': {imdbid: dict}, 'status': {status: [dicts]}}
+#       or None if not loaded
+#   generation: incremented on every write to MOVIES
+_movies = {'cache': None, 'generation': 0}
+_movies_lock = threading.Lock()
+
+# Query statistics collected by SQL.execute. See SQL.get_query_stats()
+#   {shape: {'count': int, 'time': float, 'max': float, 'rows': int, 'locked': int, 'errors': int, 'histogram': [int]}}
+_stats = {}
+_stats_lock = threading.Lock()
+_stats_since = time.time()
+
+# Upper bounds in ms of query time histogram buckets. Last bucket holds everything slower.
+_histogram_bounds = (1, 5, 10, 50, 100, 500, 1000)
+
+# Replaces literals so statements differing only in values share a shape
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_whitespace = re.compile(r'\s+')
 
 
 class SQL(object):
@@ -17,111 +51,514 @@ class SQL(object):
     On success they will return the expected data or True.
     '''
 
+    journal_modes = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+    synchronous_levels = ('off', 'normal', 'full', 'extra')
+
+    # These definitions only exist to CREATE tables.
+    # They are built once at import and shared by all instances.
+    metadata = MetaData()
+
+    MOVIES = Table('MOVIES', metadata,
+                   Column('added_date', TEXT),
+                   Column('imdbid', TEXT),
+                   Column('title', TEXT),
+                   Column('year', TEXT),
+                   Column('poster', TEXT),
+                   Column('plot', TEXT),
+                   Column('url', TEXT),
+                   Column('score', TEXT),
+                   Column('release_date', TEXT),
+                   Column('rated', TEXT),
+                   Column('status', TEXT),
+                   Column('predb', TEXT),
+                   Column('quality', TEXT),
+                   Column('finished_date', TEXT),
+                   Column('finished_score', SMALLINT),
+                   Column('finished_file', TEXT),
+                   Column('backlog', SMALLINT),
+                   Column('tmdbid', TEXT),
+                   Column('alternative_titles', TEXT),
+                   Column('digital_release_date', TEXT),
+                   Column('added_day', INTEGER),
+                   Column('release_day', INTEGER),
+                   Column('finished_day', INTEGER)
+                   )
+    SEARCHRESULTS = Table('SEARCHRESULTS', metadata,
+                          Column('score', SMALLINT),
+                          Column('size', SMALLINT),
+                          Column('status', TEXT),
+                          Column('pubdate', TEXT),
+                          Column('title', TEXT),
+                          Column('imdbid', TEXT),
+                          Column('indexer', TEXT),
+                          Column('date_found', TEXT),
+                          Column('info_link', TEXT),
+                          Column('guid', TEXT),
+                          Column('torrentfile', TEXT),
+                          Column('resolution', TEXT),
+                          Column('type', TEXT),
+                          Column('downloadid', TEXT),
+                          Column('freeleech', SMALLINT),
+                          Column('found_day', INTEGER),
+                          Column('pub_day', INTEGER)
+                          )
+    MARKEDRESULTS = Table('MARKEDRESULTS', metadata,
+                          Column('imdbid', TEXT),
+                          Column('guid', TEXT),
+                          Column('status', TEXT)
+                          )
+    # Newest item seen in each indexer's rss feed, see providers.base.RssCheckpoint
+    RSSCHECKPOINTS = Table('RSSCHECKPOINTS', metadata,
+                           Column('indexer', TEXT),
+                           Column('guid', TEXT),
+                           Column('updated', TEXT)
+                           )
+
+    # Secondary indexes. Created along with their tables in create_database,
+    #   and added to existing databases by update_indexes.
+    Index('ix_searchresults_imdbid_score_size', SEARCHRESULTS.c.imdbid, SEARCHRESULTS.c.score, SEARCHRESULTS.c.size)
+    Index('ix_searchresults_guid', SEARCHRESULTS.c.guid)
+    Index('ix_searchresults_downloadid', SEARCHRESULTS.c.downloadid)
+    Index('ix_markedresults_guid', MARKEDRESULTS.c.guid)
+    Index('ix_markedresults_imdbid', MARKEDRESULTS.c.imdbid)
+    Index('ix_movies_imdbid', MOVIES.c.imdbid)
+    Index('ix_movies_status', MOVIES.c.status)
+    Index('ix_movies_finished_day', MOVIES.c.finished_day)
+    Index('ix_searchresults_imdbid_found_day', SEARCHRESULTS.c.imdbid, SEARCHRESULTS.c.found_day)
+    Index('ix_rsscheckpoints_indexer', RSSCHECKPOINTS.c.indexer, unique=True)
+
+    # Schema version stored in PRAGMA user_version. When changing the schema add
+    #   a method that migrates from the previous version to self.migrations
+    #   and bump schema_version to match.
+    schema_version = 3
+
+    # [(version, method name)] run in order by update_tables
+    migrations = [(1, '_migrate_1'),
+                  (2, '_migrate_2'),
+                  (3, '_migrate_3')
+                  ]
+
+    # Text date columns and the INTEGER day number columns kept in sync with them
+    #   by write, update, update_many, update_multiple, and write_search_results.
+    #   Day numbers count days since 1970-01-01, see SQL.day_number()
+    # {TABLENAME: {date_col: day_col}}
+    day_columns = {'MOVIES': {'added_date': 'added_day',
+                              'release_date': 'release_day',
+                              'finished_date': 'finished_day'
+                              },
+                   'SEARCHRESULTS': {'date_found': 'found_day',
+                                     'pubdate': 'pub_day'
+                                     }
+                   }
+
+    # Formats of dates stored in text columns. pubdate is stored as '05 Jan 2017'
+    date_formats = ('%Y-%m-%d', '%d %b %Y')
+
+    # Formatted statements. {(template, identifiers): 'SQL'}
+    statements = {}
+
     def __init__(self):
-        DB_NAME = u'sqlite:///{}'.format(core.DB_FILE)
-        try:
-            self.engine = create_engine(DB_NAME, echo=False, connect_args={'timeout': 30})
-            self.metadata = MetaData()
-        except (SystemExit, KeyboardInterrupt):
-            raise
-        except Exception, e: # noqa
-            logging.error(u'Opening SQL DB.', exc_info=True)
-            raise
+        self.engine = SQL.get_engine()
 
-        # These definitions only exist to CREATE tables.
-        self.MOVIES = Table('MOVIES', self.metadata,
-                            Column('added_date', TEXT),
-                            Column('imdbid', TEXT),
-                            Column('title', TEXT),
-                            Column('year', TEXT),
-                            Column('poster', TEXT),
-                            Column('plot', TEXT),
-                            Column('url', TEXT),
-                            Column('score', TEXT),
-                            Column('release_date', TEXT),
-                            Column('rated', TEXT),
-                            Column('status', TEXT),
-                            Column('predb', TEXT),
-                            Column('quality', TEXT),
-                            Column('finished_date', TEXT),
-                            Column('finished_score', SMALLINT),
-                            Column('finished_file', TEXT),
-                            Column('backlog', SMALLINT),
-                            Column('tmdbid', TEXT),
-                            Column('alternative_titles', TEXT),
-                            Column('digital_release_date', TEXT)
-                            )
-        self.SEARCHRESULTS = Table('SEARCHRESULTS', self.metadata,
-                                   Column('score', SMALLINT),
-                                   Column('size', SMALLINT),
-                                   Column('status', TEXT),
-                                   Column('pubdate', TEXT),
-                                   Column('title', TEXT),
-                                   Column('imdbid', TEXT),
-                                   Column('indexer', TEXT),
-                                   Column('date_found', TEXT),
-                                   Column('info_link', TEXT),
-                                   Column('guid', TEXT),
-                                   Column('torrentfile', TEXT),
-                                   Column('resolution', TEXT),
-                                   Column('type', TEXT),
-                                   Column('downloadid', TEXT),
-                                   Column('freeleech', SMALLINT)
-                                   )
-        self.MARKEDRESULTS = Table('MARKEDRESULTS', self.metadata,
-                                   Column('imdbid', TEXT),
-                                   Column('guid', TEXT),
-                                   Column('status', TEXT)
-                                   )
+    @staticmethod
+    def get_engine():
+        ''' Gets the shared engine for core.DB_FILE
+        Creates engine on first call. Every later call, from any thread, gets the
+            same engine and connection pool.
 
-        # {TABLENAME: [(new_col, old_col), (new_col, old_col)]}
-        self.convert_names = {'MOVIES':
-                              [('url', 'tomatourl'),
-                               ('score', 'tomatorating'),
-                               ('release_date', 'released'),
-                               ('finished_date', 'finisheddate')
-                               ]}
+        The pool keeps Database.poolsize connections open and allows up to
+            Database.pooloverflow more under load. Threads wait up to
+            Database.busytimeout seconds for a free connection.
+
+        Each connection keeps the last Database.cachedstatements prepared
+            statements, so parameterized queries are only parsed once.
+
+        Returns object sqlalchemy engine
+        '''
+
+        with _engine_lock:
+            engine = _engines.get(core.DB_FILE)
+            if engine is not None:
+                return engine
+
+            db_conf = core.CONFIG['Database']
+
+            DB_NAME = u'sqlite:///{}'.format(core.DB_FILE)
+            logging.info(u'Opening SQL DB {}.'.format(core.DB_FILE))
+
+            try:
+                engine = create_engine(DB_NAME, echo=False,
+                                       poolclass=QueuePool,
+                                       pool_size=db_conf['poolsize'],
+                                       max_overflow=db_conf['pooloverflow'],
+                                       pool_timeout=db_conf['busytimeout'],
+                                       connect_args={'timeout': db_conf['busytimeout'],
+                                                     'check_same_thread': False,
+                                                     'cached_statements': db_conf['cachedstatements']}
+                                       )
+                event.listen(engine, 'connect', SQL._configure_connection)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception, e: # noqa
+                logging.error(u'Opening SQL DB.', exc_info=True)
+                raise
+
+            _engines[core.DB_FILE] = engine
+            return engine
+
+    @staticmethod
+    def _configure_connection(dbapi_connection, connection_record):
+        ''' Sets storage mode on each new sqlite connection
+        dbapi_connection: sqlite3 connection
+
+        Applies journal mode, synchronous level and busy timeout from config.
+
+        auto_vacuum is set first. It only takes effect on a new, empty database
+            and cannot change once the file is in WAL mode, so a database
+            created by this connection starts in incremental mode. Existing
+            databases are converted by self.optimize().
+
+        WAL journal mode lets readers continue while the searcher is writing. Any
+            connection that hits a lock waits up to busytimeout seconds for it
+            to clear instead of failing immediately.
+
+        Does not return
+        '''
+
+        db_conf = core.CONFIG['Database']
+
+        journal_mode = db_conf['journalmode'].lower()
+        synchronous = db_conf['synchronous'].lower()
+        busy_timeout = int(db_conf['busytimeout'] * 1000)
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute(u'PRAGMA auto_vacuum=INCREMENTAL')
+        if journal_mode in SQL.journal_modes:
+            cursor.execute(u'PRAGMA journal_mode={}'.format(journal_mode))
+        else:
+            logging.warning(u'Invalid database journal mode {}.'.format(journal_mode))
+        if synchronous in SQL.synchronous_levels:
+            cursor.execute(u'PRAGMA synchronous={}'.format(synchronous))
+        else:
+            logging.warning(u'Invalid database synchronous level {}.'.format(synchronous))
+        cursor.execute(u'PRAGMA busy_timeout={}'.format(busy_timeout))
+        cursor.close()
 
     def create_database(self):
         logging.info(u'Creating tables.')
         self.metadata.create_all(self.engine)
+        self.set_user_version(self.schema_version)
+        self.invalidate_movies()
         return
 
     def execute(self, command):
         ''' Executes SQL command
         command: str or list of SQL commands
 
-        We are going to loop this up to 5 times in case the database is locked.
-        After each attempt we wait 1 second to try again. This allows the query
-            that has the database locked to (hopefully) finish. It might
-            (i'm not sure) allow a query to jump in line between a series of
-            queries. So if we are writing searchresults to every movie at once,
-            the get_user_movies request may be able to jump in between them to
-            get the user's movies to the browser. Maybe.
+        Locking is left to SQLite. If the database is locked the connection waits
+            up to Database.busytimeout seconds for the lock to clear. In WAL mode
+            only writers wait on each other, readers are never blocked.
 
-        Returns result of command, or False if unable to execute
+        If called inside self.transaction() the command runs on the transaction's
+            connection and a locked database raises instead of returning False.
+
+        Statements that return no rows and take longer than
+            Database.slowwritethreshold ms are logged. The time includes any wait
+            for another writer's lock, which sqlite does not report separately.
+
+        Returns result of command, or False if the database stayed locked
         '''
 
-        tries = 0
-        while tries < 5:
-            try:
-                if type(command) == list:
-                    result = self.engine.execute(*command)
-                else:
-                    result = self.engine.execute(command)
-                return result
+        connection = getattr(_local, 'connection', None)
 
-            except Exception as e:
-                logging.error(u'SQL Database Query: {}.'.format(command), exc_info=True)
-                if 'database is locked' in e.args[0]:
-                    logging.debug(u'SQL Query attempt # {}.'.format(tries))
-                    tries += 1
-                    time.sleep(1)
-                else:
-                    logging.error(u'SQL Databse Query: {}.'.format(command), exc_info=True)
+        start = time.time()
+        try:
+            if type(command) == list:
+                result = (connection or self.engine).execute(*command)
+            else:
+                result = (connection or self.engine).execute(command)
+            elapsed = time.time() - start
+            self._record(command, elapsed, rows=result.rowcount)
+            if elapsed * 1000 >= core.CONFIG['Database']['slowwritethreshold'] and not result.returns_rows:
+                logging.warning(u'Slow SQL statement took {:.2f} seconds: {}.'.format(elapsed, self._shape(command)))
+            return result
+
+        except Exception as e:
+            if 'database is locked' in str(e):
+                self._record(command, time.time() - start, locked=True)
+                logging.error(u'SQL Database still locked after waiting {:.2f} seconds: {}.'.format(time.time() - start, command))
+                if connection is not None:
                     raise
-        # all tries exhausted
-        return False
+                return False
+            else:
+                self._record(command, time.time() - start, error=True)
+                logging.error(u'SQL Database Query: {}.'.format(command), exc_info=True)
+                raise
+
+    def _shape(self, command):
+        ''' Gets normalized form of SQL command
+        command: str or list of SQL commands, as passed to self.execute()
+
+        Collapses whitespace and replaces literal numbers and strings with ?
+
+        Returns unicode
+        '''
+
+        sql = command[0] if type(command) == list else command
+        sql = _whitespace.sub(u' ', unicode(sql)).strip()
+        return _literals.sub(u'?', sql)
+
+    def _record(self, command, elapsed, rows=-1, locked=False, error=False):
+        ''' Adds execution of command to query statistics
+        command: str or list of SQL commands, as passed to self.execute()
+        elapsed: float seconds command took to execute
+        rows: int rows affected, or -1 if unknown (ie SELECT) <default -1>
+        locked: bool if command failed because database was locked <default False>
+        error: bool if command failed for any other reason <default False>
+
+        Commands slower than Database.slowquerythreshold ms are written to the
+            slow query log along with the function that executed them.
+
+        Does not return
+        '''
+
+        shape = self._shape(command)
+        ms = elapsed * 1000
+
+        bucket = len(_histogram_bounds)
+        for i, bound in enumerate(_histogram_bounds):
+            if ms < bound:
+                bucket = i
+                break
+
+        with _stats_lock:
+            stat = _stats.get(shape)
+            if stat is None:
+                stat = _stats[shape] = {'count': 0, 'time': 0.0, 'max': 0.0, 'rows': 0, 'locked': 0, 'errors': 0,
+                                        'histogram': [0] * (len(_histogram_bounds) + 1)}
+            stat['count'] += 1
+            stat['time'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+            stat['histogram'][bucket] += 1
+            if rows > 0:
+                stat['rows'] += rows
+            if locked:
+                stat['locked'] += 1
+            if error:
+                stat['errors'] += 1
+
+        if ms >= core.CONFIG['Database']['slowquerythreshold']:
+            slow_log.warning(u'{:.1f}ms in {}: {}'.format(ms, self._caller(), shape))
+
+    def _caller(self):
+        ''' Gets name of function outside this module that executed SQL
+
+        Returns str module.function
+        '''
+
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_globals.get('__name__') in (__name__, 'contextlib'):
+            frame = frame.f_back
+        if frame is None:
+            return u'unknown'
+        return u'{}.{}'.format(frame.f_globals.get('__name__'), frame.f_code.co_name)
+
+    def get_query_stats(self):
+        ''' Gets statistics of every statement executed since start or last reset
+
+        Statements are grouped by shape, see self._shape(). Times are in ms.
+            rows only counts rows changed by INSERT, UPDATE, and DELETE.
+
+        Returns dict {'since': str, 'histogram': [str], 'queries': [dict]} with queries
+            sorted by total time
+        '''
+
+        with _stats_lock:
+            stats = [(shape, dict(stat, histogram=list(stat['histogram']))) for shape, stat in _stats.iteritems()]
+            since = _stats_since
+
+        queries = []
+        for shape, stat in stats:
+            queries.append({'query': shape,
+                            'count': stat['count'],
+                            'total_ms': round(stat['time'] * 1000, 2),
+                            'mean_ms': round(stat['time'] * 1000 / stat['count'], 2),
+                            'max_ms': round(stat['max'] * 1000, 2),
+                            'rows': stat['rows'],
+                            'locked': stat['locked'],
+                            'errors': stat['errors'],
+                            'histogram': stat['histogram']
+                            })
+        queries.sort(key=lambda q: q['total_ms'], reverse=True)
+
+        histogram = [u'<{}ms'.format(i) for i in _histogram_bounds] + [u'>={}ms'.format(_histogram_bounds[-1])]
+
+        return {'since': str(datetime.datetime.fromtimestamp(since).replace(microsecond=0)),
+                'histogram': histogram,
+                'queries': queries
+                }
+
+    def reset_query_stats(self):
+        ''' Clears all query statistics
+
+        Does not return
+        '''
+
+        global _stats_since
+        with _stats_lock:
+            _stats.clear()
+            _stats_since = time.time()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        ''' Groups statements into a single transaction
+        Use as a context manager:
+
+            with self.sql.transaction():
+                self.sql.purge_search_results(imdbid=imdbid)
+                self.sql.write_search_results(results)
+
+        Until the block exits every SQL instance in this thread runs its statements
+            on one connection. All changes are committed together, with a single
+            fsync, when the block finishes. If the block raises all changes are
+            rolled back and the exception is re-raised.
+
+        Nested calls join the outermost transaction.
+
+        Reads of MOVIES inside a transaction skip the movie cache so they see
+            uncommitted changes.
+
+        Yields self
+        '''
+
+        if getattr(_local, 'connection', None) is not None:
+            yield self
+            return
+
+        connection = self.engine.connect()
+        trans = connection.begin()
+        _local.connection = connection
+        _local.movies_changed = False
+        try:
+            yield self
+            trans.commit()
+        except BaseException:
+            logging.warning(u'Rolling back SQL transaction.')
+            trans.rollback()
+            raise
+        finally:
+            _local.connection = None
+            connection.close()
+            # other threads may have cached MOVIES before this transaction committed
+            if _local.movies_changed:
+                self.invalidate_movies()
+
+    def statement(self, template, **identifiers):
+        ''' Builds parameterized SQL statement
+        template: str SQL with {named} fields for identifiers and ? for values
+        identifiers: table and column names to format into template
+
+        Identifiers cannot be bound as parameters, so they are checked against
+            the tables and columns in self.metadata before formatting.
+
+        Formatted statements are cached. Repeat calls return the identical string,
+            which lets sqlite reuse the prepared statement instead of parsing
+            a new one every call.
+
+        Returns str SQL statement
+        '''
+
+        key = (template, tuple(sorted(identifiers.items())))
+
+        sql = SQL.statements.get(key)
+        if sql is None:
+            for name in identifiers.values():
+                if not self._valid_identifier(name):
+                    logging.error(u'Invalid SQL identifier {}.'.format(name))
+                    raise ValueError(u'Invalid SQL identifier {}'.format(name))
+            sql = template.format(**identifiers)
+            SQL.statements[key] = sql
+        return sql
+
+    def _valid_identifier(self, name):
+        ''' Checks if name is a known table or column
+        name: str identifier to check
+
+        Returns Bool
+        '''
+
+        if name in self.metadata.tables:
+            return True
+        return any(name in table.c for table in self.metadata.tables.values())
+
+    def query(self, template, params=(), **identifiers):
+        ''' Executes parameterized SQL statement
+        template: str SQL template, see self.statement()
+        params: tuple values to bind to ? placeholders <optional>
+        identifiers: table and column names to format into template
+
+        Values are always bound by sqlite, never formatted into the statement, so
+            they may safely contain quotes or any other character.
+
+        Returns result of command, or False if unable to execute
+        '''
+
+        return self.execute([self.statement(template, **identifiers), params])
+
+    @staticmethod
+    def day_number(value):
+        ''' Converts date to day number
+        value: date, datetime, or str date in one of SQL.date_formats
+
+        Day numbers are days since 1970-01-01, matching
+            CAST(julianday(date) - 2440587.5 AS INTEGER) in sqlite.
+
+        Returns int, or None if value is empty or cannot be parsed
+        '''
+
+        if not value:
+            return None
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        if not isinstance(value, datetime.date):
+            for date_format in SQL.date_formats:
+                try:
+                    value = datetime.datetime.strptime(value, date_format).date()
+                    break
+                except (ValueError, TypeError):
+                    continue
+            else:
+                return None
+        return (value - datetime.date(1970, 1, 1)).days
+
+    @staticmethod
+    def today():
+        ''' Gets day number of today's date
+
+        Returns int
+        '''
+
+        return SQL.day_number(datetime.date.today())
+
+    def _add_days(self, TABLE, data):
+        ''' Adds day number columns to row data
+        TABLE: str database table to access
+        data: dict key/value pairs to write to table
+
+        Does not modify data.
+
+        Returns dict of data with day number columns added
+        '''
+
+        days = self.day_columns.get(TABLE)
+        if not days:
+            return data
+
+        data = dict(data)
+        for date_col, day_col in days.iteritems():
+            if date_col in data:
+                data[day_col] = self.day_number(data[date_col])
+        return data
 
     def write(self, TABLE, DB_STRING):
         '''
@@ -132,6 +569,8 @@ class SQL(object):
 
         logging.info(u'Writing data to {}.'.format(TABLE))
 
+        DB_STRING = self._add_days(TABLE, DB_STRING)
+
         cols = u', '.join(DB_STRING.keys())
         vals = DB_STRING.values()
 
@@ -142,6 +581,8 @@ class SQL(object):
         command = [sql, vals]
 
         if self.execute(command):
+            if TABLE == 'MOVIES':
+                self.invalidate_movies()
             return True
         else:
             logging.error(u'Unable to write to database.')
@@ -157,6 +598,8 @@ class SQL(object):
 
         logging.info(u'Writing batch into SEARCHRESULTS.')
 
+        LIST = [self._add_days('SEARCHRESULTS', i) for i in LIST]
+
         INSERT = self.SEARCHRESULTS.insert()
 
         command = [INSERT, LIST]
@@ -177,17 +620,50 @@ class SQL(object):
 
         logging.info(u'Updating {}:{} to {} in {}.'.format(idcol, idval.split('&')[0], VALUE, TABLE))
 
-        sql = u'UPDATE {} SET {}=? WHERE {}=?'.format(TABLE, COLUMN, idcol)
-        vals = (VALUE, idval)
-
-        command = [sql, vals]
+        day_col = self.day_columns.get(TABLE, {}).get(COLUMN)
+        if day_col:
+            result = self.query(u'UPDATE {table} SET {column}=?, {day_col}=? WHERE {idcol}=?', (VALUE, self.day_number(VALUE), idval), table=TABLE, column=COLUMN, day_col=day_col, idcol=idcol)
+        else:
+            result = self.query(u'UPDATE {table} SET {column}=? WHERE {idcol}=?', (VALUE, idval), table=TABLE, column=COLUMN, idcol=idcol)
 
-        if self.execute(command):
+        if result:
+            if TABLE == 'MOVIES':
+                self.invalidate_movies()
             return True
         else:
             logging.error(u'Unable to update database row.')
             return False
 
+    def update_many(self, TABLE, COLUMN, idcol, rows):
+        ''' Updates single value in many table rows with one statement
+        TABLE: str database table to access
+        COLUMN: str column to set
+        idcol: str identifying column
+        rows: list of tuples [(value, idval), (value, idval)]
+
+        Returns Bool.
+        '''
+
+        if not rows:
+            return True
+
+        logging.info(u'Updating {} for {} rows in {}.'.format(COLUMN, len(rows), TABLE))
+
+        day_col = self.day_columns.get(TABLE, {}).get(COLUMN)
+        if day_col:
+            rows = [(value, self.day_number(value), idval) for value, idval in rows]
+            result = self.query(u'UPDATE {table} SET {column}=?, {day_col}=? WHERE {idcol}=?', rows, table=TABLE, column=COLUMN, day_col=day_col, idcol=idcol)
+        else:
+            result = self.query(u'UPDATE {table} SET {column}=? WHERE {idcol}=?', rows, table=TABLE, column=COLUMN, idcol=idcol)
+
+        if result:
+            if TABLE == 'MOVIES':
+                self.invalidate_movies()
+            return True
+        else:
+            logging.error(u'Unable to update database rows.')
+            return False
+
     def update_multiple(self, TABLE, data, imdbid='', guid=''):
         ''' Updates mulitple values in sql row
         TABLE: str database table to access
@@ -209,6 +685,8 @@ class SQL(object):
 
         logging.info(u'Updating {} in {}.'.format(idval.split('&')[0], TABLE))
 
+        data = self._add_days(TABLE, data)
+
         columns = '{}=?'.format('=?,'.join(data.keys()))
 
         sql = u'UPDATE {} SET {} WHERE {}=?'.format(TABLE, columns, idcol)
@@ -218,33 +696,117 @@ class SQL(object):
         command = [sql, vals]
 
         if self.execute(command):
+            if TABLE == 'MOVIES':
+                self.invalidate_movies()
             return True
         else:
             logging.error(u'Unable to update database row.')
             return False
 
-    def get_user_movies(self):
-        ''' Gets all info in MOVIES
+    def invalidate_movies(self):
+        ''' Discards cached MOVIES table
+        Called after every write to MOVIES. The next read reloads the table.
 
-        Returns list of dicts with all information in MOVIES
+        Inside a transaction the cache is also discarded when the transaction
+            closes, since other threads can only see the changes after commit.
+
+        Does not return
         '''
 
-        logging.info(u'Retreving list of user\'s movies.')
-        TABLE = u'MOVIES'
+        with _movies_lock:
+            _movies['generation'] += 1
+            _movies['cache'] = None
+
+        if getattr(_local, 'connection', None) is not None:
+            _local.movies_changed = True
 
-        command = u'SELECT * FROM {} ORDER BY title ASC'.format(TABLE)
+    def _load_movies(self):
+        ''' Reads all rows in MOVIES from database
 
-        result = self.execute(command)
+        Returns list of dicts ordered by title, or False on failure
+        '''
+
+        logging.info(u'Retreving list of user\'s movies.')
+        result = self.query(u'SELECT * FROM MOVIES ORDER BY title ASC')
 
         if result:
-            lst = []
-            for i in result:
-                lst.append(dict(i))
-            return lst
+            return [dict(i) for i in result]
         else:
             logging.error(u'Unable to get list of user\'s movies.')
             return False
 
+    def _movie_cache(self):
+        ''' Gets cached MOVIES table, loading it if required
+
+        Returns None inside a transaction so callers read uncommitted rows directly.
+
+        The table is loaded without holding the lock. If a write lands while it
+            loads the generation changes and the possibly stale rows are returned
+            to this caller but not stored.
+
+        Returns dict {'movies': list, 'imdbid': dict, 'status': dict}, None, or False on failure
+        '''
+
+        if getattr(_local, 'connection', None) is not None:
+            return None
+
+        with _movies_lock:
+            if _movies['cache'] is not None:
+                return _movies['cache']
+            generation = _movies['generation']
+
+        movies = self._load_movies()
+        if movies is False:
+            return False
+
+        cache = {'movies': movies, 'imdbid': {}, 'status': {}}
+        for movie in movies:
+            cache['imdbid'].setdefault(movie['imdbid'], movie)
+            cache['status'].setdefault(movie['status'], []).append(movie)
+
+        with _movies_lock:
+            if _movies['generation'] == generation:
+                _movies['cache'] = cache
+        return cache
+
+    def get_user_movies(self):
+        ''' Gets all info in MOVIES
+
+        Served from the movie cache. Dicts are copies and may be modified freely.
+
+        Returns list of dicts with all information in MOVIES
+        '''
+
+        cache = self._movie_cache()
+
+        if cache is None:
+            return self._load_movies()
+        elif cache is False:
+            return False
+        else:
+            return [dict(i) for i in cache['movies']]
+
+    def get_movies_by_status(self, status):
+        ''' Gets all movies with status
+        status: str status to match
+
+        Served from the movie cache. Dicts are copies and may be modified freely.
+
+        Returns list of dicts ordered by title
+        '''
+
+        cache = self._movie_cache()
+
+        if cache is None:
+            result = self.query(u'SELECT * FROM MOVIES WHERE status=? ORDER BY title ASC', (status,))
+            if not result:
+                return False
+            return [dict(i) for i in result]
+        elif cache is False:
+            return False
+        else:
+            return [dict(i) for i in cache['status'].get(status, [])]
+
     def get_movie_details(self, idcol, idval):
         ''' Returns dict of single movie details from MOVIES.
         :param idcol: str identifying column
@@ -252,14 +814,23 @@ class SQL(object):
 
         Looks through MOVIES for idcol:idval
 
+        Lookups by imdbid are served from the movie cache.
+
         Returns dict of first match
         '''
 
         logging.info(u'Retreving details for {}.'.format(idval))
 
-        command = u'SELECT * FROM MOVIES WHERE {}="{}"'.format(idcol, idval)
+        if idcol == 'imdbid':
+            cache = self._movie_cache()
+            if cache:
+                data = cache['imdbid'].get(idval)
+                if data:
+                    return dict(data)
+                else:
+                    return False
 
-        result = self.execute(command)
+        result = self.query(u'SELECT * FROM MOVIES WHERE {idcol}=?', (idval,), idcol=idcol)
 
         if result:
             data = result.fetchone()
@@ -270,6 +841,42 @@ class SQL(object):
         else:
             return False
 
+    def get_movies_finished_within(self, days):
+        ''' Gets Finished movies whose finished_date is within the last N days
+        days: int number of days to look back
+
+        Movies finished exactly N days ago are included.
+
+        Returns list of dicts ordered by title, or False on failure
+        '''
+
+        result = self.query(u'''SELECT * FROM MOVIES WHERE status='Finished' AND finished_day >= ?
+                                ORDER BY title ASC''', (self.today() - days,))
+
+        if result:
+            return [dict(i) for i in result]
+        else:
+            return False
+
+    def get_earliest_found(self, imdbid, types=None):
+        ''' Gets earliest date_found of movie's search results
+        imdbid: str imdb id #
+        types: list of str result types to consider, ie ['nzb', 'torrent'] <optional>
+
+        Returns int day number, see self.day_number(), or None if no results found
+        '''
+
+        if types:
+            command = u'SELECT MIN(found_day) FROM SEARCHRESULTS WHERE imdbid=? AND type IN ({})'.format(u', '.join(['?'] * len(types)))
+            result = self.query(command, tuple([imdbid] + list(types)))
+        else:
+            result = self.query(u'SELECT MIN(found_day) FROM SEARCHRESULTS WHERE imdbid=?', (imdbid,))
+
+        if result:
+            return result.fetchone()[0]
+        else:
+            return None
+
     def get_search_results(self, imdbid, quality=None):
         ''' Gets all search results for a given movie
         :param imdbid: str imdb id #
@@ -283,17 +890,11 @@ class SQL(object):
         Returns list of dicts for all SEARCHRESULTS that match imdbid
         '''
 
-        if quality in core.CONFIG['Quality']['Profiles'] and core.CONFIG['Quality']['Profiles'][quality]['prefersmaller']:
-            sort = 'ASC'
-        else:
-            sort = 'DESC'
+        command = u'SELECT * FROM SEARCHRESULTS WHERE imdbid=? {}'.format(self._result_order(quality))
 
         logging.info(u'Retreving Search Results for {}.'.format(imdbid))
-        TABLE = u'SEARCHRESULTS'
 
-        command = u'SELECT * FROM {} WHERE imdbid="{}" ORDER BY score DESC, size {}, freeleech DESC'.format(TABLE, imdbid, sort)
-
-        results = self.execute(command)
+        results = self.query(command, (imdbid,))
 
         if results:
             res = results.fetchall()
@@ -301,6 +902,111 @@ class SQL(object):
         else:
             return False
 
+    def _result_order(self, quality):
+        ''' Gets ORDER BY clause for search results
+        quality: str name of quality profile
+
+        Sorts by score, then size, then freeleech. Looks at quality to determine
+            size sort direction. If not passed defaults to DESC, with bigger files first.
+
+        Returns str
+        '''
+
+        if quality in core.CONFIG['Quality']['Profiles'] and core.CONFIG['Quality']['Profiles'][quality]['prefersmaller']:
+            return u'ORDER BY score DESC, size ASC, freeleech DESC'
+        else:
+            return u'ORDER BY score DESC, size DESC, freeleech DESC'
+
+    def _result_filter(self, imdbid, types):
+        ''' Gets WHERE clause and parameters for a movie's search results
+        imdbid: str imdb id #
+        types: list of str result types to include, or None for all
+
+        Returns tuple (str, list)
+        '''
+
+        if types:
+            where = u'WHERE imdbid=? AND type IN ({})'.format(u', '.join([u'?'] * len(types)))
+            return where, [imdbid] + list(types)
+        else:
+            return u'WHERE imdbid=?', [imdbid]
+
+    def get_search_results_page(self, imdbid, quality=None, columns=None, types=None, limit=50, offset=0):
+        ''' Gets one page of search results for a given movie
+        imdbid: str imdb id #
+        quality: str name of quality profile. Used to sort order <optional>
+        columns: list of str columns to return <default all>
+        types: list of str result types to include, ie ['nzb', 'torrent'] <default all>
+        limit: int max number of results to return <default 50>
+        offset: int number of results to skip <default 0>
+
+        Sorted the same as self.get_search_results(). Use with self.count_search_results()
+            to page through large result sets.
+
+        Returns list of dicts
+        '''
+
+        if columns:
+            for column in columns:
+                if column not in self.SEARCHRESULTS.c:
+                    logging.error(u'Invalid SQL identifier {}.'.format(column))
+                    raise ValueError(u'Invalid SQL identifier {}'.format(column))
+            select = u', '.join(columns)
+        else:
+            select = u'*'
+
+        where, params = self._result_filter(imdbid, types)
+        command = u'SELECT {} FROM SEARCHRESULTS {} {} LIMIT ? OFFSET ?'.format(select, where, self._result_order(quality))
+
+        logging.info(u'Retreving Search Results {}-{} for {}.'.format(offset, offset + limit, imdbid))
+
+        results = self.query(command, tuple(params + [limit, offset]))
+
+        if results:
+            return [dict(i) for i in results]
+        else:
+            return False
+
+    def count_search_results(self, imdbid, types=None):
+        ''' Counts search results for a given movie
+        imdbid: str imdb id #
+        types: list of str result types to include, ie ['nzb', 'torrent'] <default all>
+
+        Returns int
+        '''
+
+        where, params = self._result_filter(imdbid, types)
+        result = self.query(u'SELECT COUNT(*) FROM SEARCHRESULTS {}'.format(where), tuple(params))
+
+        if result:
+            return result.fetchone()[0]
+        else:
+            return 0
+
+    def get_best_result(self, imdbid, quality=None, types=None):
+        ''' Gets highest ranked result that is Available, Snatched, or Finished
+        imdbid: str imdb id #
+        quality: str name of quality profile. Used to sort order <optional>
+        types: list of str result types to include, ie ['nzb', 'torrent'] <default all>
+
+        Bad and other results are skipped. If the returned result is Snatched or
+            Finished the best release has already been grabbed.
+
+        Returns dict of result, or None if no results match
+        '''
+
+        where, params = self._result_filter(imdbid, types)
+        command = u'''SELECT * FROM SEARCHRESULTS {} AND status IN ('Available', 'Snatched', 'Finished')
+                      {} LIMIT 1'''.format(where, self._result_order(quality))
+
+        result = self.query(command, tuple(params))
+
+        if result:
+            row = result.fetchone()
+            if row:
+                return dict(row)
+        return None
+
     def get_marked_results(self, imdbid):
         ''' Gets all entries in MARKEDRESULTS for given movie
         :param imdbid: str imdb id #
@@ -310,13 +1016,9 @@ class SQL(object):
 
         logging.info(u'Retreving Marked Results for {}.'.format(imdbid))
 
-        TABLE = u'MARKEDRESULTS'
-
         results = {}
 
-        command = u'SELECT * FROM {} WHERE imdbid="{}"'.format(TABLE, imdbid)
-
-        data = self.execute(command)
+        data = self.query(u'SELECT * FROM MARKEDRESULTS WHERE imdbid=?', (imdbid,))
 
         if data:
             for i in data.fetchall():
@@ -363,9 +1065,9 @@ class SQL(object):
 
         logging.info(u'Removing from {} where {} is {}.'.format(TABLE, idcol, idval.split('&')[0]))
 
-        command = u'DELETE FROM {} WHERE {}="{}"'.format(TABLE, idcol, idval)
-
-        if self.execute(command):
+        if self.query(u'DELETE FROM {table} WHERE {idcol}=?', (idval,), table=TABLE, idcol=idcol):
+            if TABLE == 'MOVIES':
+                self.invalidate_movies()
             return True
         else:
             return False
@@ -382,18 +1084,95 @@ class SQL(object):
         Returns Bool
         '''
 
-        TABLE = u'SEARCHRESULTS'
-
         if imdbid:
-            command = u'DELETE FROM {} WHERE imdbid="{}"'.format(TABLE, imdbid)
+            result = self.query(u'DELETE FROM SEARCHRESULTS WHERE imdbid=?', (imdbid,))
         else:
-            command = u'DELETE FROM {}'.format(TABLE)
+            result = self.query(u'DELETE FROM SEARCHRESULTS')
 
-        if self.execute(command):
+        if result:
             return True
         else:
             return False
 
+    def prune_search_results(self, days):
+        ''' Deletes old search results of movies no longer being searched for
+        days: int age in days of results to delete
+
+        Only removes results found more than N days ago belonging to Finished or
+            Disabled movies. Results that are Snatched or Finished, or have an
+            entry in MARKEDRESULTS, are always kept.
+
+        Returns int number of rows deleted, or False on failure
+        '''
+
+        logging.info(u'Pruning search results older than {} days.'.format(days))
+
+        result = self.query(u'''DELETE FROM SEARCHRESULTS
+                                WHERE found_day < ?
+                                AND status NOT IN ('Snatched', 'Finished')
+                                AND imdbid IN (SELECT imdbid FROM MOVIES WHERE status IN ('Finished', 'Disabled'))
+                                AND guid NOT IN (SELECT guid FROM MARKEDRESULTS WHERE guid IS NOT NULL)''',
+                            (self.today() - days,))
+
+        if result:
+            return result.rowcount
+        else:
+            return False
+
+    def get_size(self):
+        ''' Gets size of database file
+
+        Returns int bytes
+        '''
+
+        page_size = self.execute(u'PRAGMA page_size').fetchone()[0]
+        page_count = self.execute(u'PRAGMA page_count').fetchone()[0]
+        return page_size * page_count
+
+    def optimize(self):
+        ''' Runs database maintenance
+
+        Updates query planner statistics with ANALYZE and returns free pages to
+            the filesystem with an incremental vacuum.
+
+        Incremental vacuum requires auto_vacuum=INCREMENTAL, which only takes
+            effect after a full VACUUM. If the database is not already in that
+            mode it is converted once with a full VACUUM.
+
+        Then runs an integrity check.
+
+        Returns Bool True if database passes integrity check
+        '''
+
+        logging.info(u'Analyzing database.')
+        self.execute(u'ANALYZE')
+
+        if self.execute(u'PRAGMA auto_vacuum').fetchone()[0] != 2:
+            logging.info(u'Converting database to incremental auto_vacuum. This may take some time.')
+            self.execute(u'PRAGMA auto_vacuum = INCREMENTAL')
+            self.execute(u'VACUUM')
+        else:
+            free = self.execute(u'PRAGMA freelist_count').fetchone()[0]
+            logging.info(u'Releasing {} free pages.'.format(free))
+            # Frees one page per step and returns no rows, so it is stepped on a raw cursor
+            connection = self.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(u'PRAGMA incremental_vacuum')
+                cursor.fetchall()
+                cursor.close()
+                connection.commit()
+            finally:
+                connection.close()
+
+        logging.info(u'Checking database integrity.')
+        errors = [i[0] for i in self.execute(u'PRAGMA integrity_check').fetchall()]
+        if errors != [u'ok']:
+            for i in errors:
+                logging.error(u'Database integrity check: {}'.format(i))
+            return False
+        return True
+
     def get_distinct(self, TABLE, column, idcol, idval):
         ''' Gets unique values in TABLE
         :param TABLE: str table name
@@ -408,9 +1187,7 @@ class SQL(object):
 
         logging.info(u'Getting distinct values for {} in {}'.format(idval.split('&')[0], TABLE))
 
-        command = u'SELECT DISTINCT {} FROM {} WHERE {}="{}"'.format(column, TABLE, idcol, idval)
-
-        data = self.execute(command)
+        data = self.query(u'SELECT DISTINCT {column} FROM {table} WHERE {idcol}=?', (idval,), column=column, table=TABLE, idcol=idcol)
 
         if data:
             data = data.fetchall()
@@ -426,6 +1203,113 @@ class SQL(object):
             logging.error(u'Unable to read database.')
             return False
 
+    def get_result_ranks(self, imdbids=None):
+        ''' Gets status of movies and the best status of their search results
+        imdbids: list of str imdb id #s <optional>
+
+        Aggregates SEARCHRESULTS in a single query. Search result statuses
+            are ranked Finished: 3, Snatched: 2, Available: 1, anything else,
+            or no results at all: 0.
+
+        If imdbids is not supplied, returns every movie in MOVIES.
+
+        Returns dict {imdbid: (movie status, best result rank)}
+        '''
+
+        command = u'''SELECT MOVIES.imdbid AS imdbid, MOVIES.status AS status,
+                      MAX(CASE SEARCHRESULTS.status
+                          WHEN 'Finished' THEN 3
+                          WHEN 'Snatched' THEN 2
+                          WHEN 'Available' THEN 1
+                          ELSE 0 END) AS rank
+                      FROM MOVIES LEFT JOIN SEARCHRESULTS ON SEARCHRESULTS.imdbid = MOVIES.imdbid
+                      {where}
+                      GROUP BY MOVIES.imdbid'''
+
+        ranks = {}
+
+        if imdbids is None:
+            chunks = [None]
+        else:
+            imdbids = list(imdbids)
+            chunks = [imdbids[i:i + 500] for i in range(0, len(imdbids), 500)]
+
+        for chunk in chunks:
+            if chunk is None:
+                data = self.execute(command.format(where=u''))
+            else:
+                where = u'WHERE MOVIES.imdbid IN ({})'.format(u', '.join(['?'] * len(chunk)))
+                data = self.execute([command.format(where=where), chunk])
+
+            if not data:
+                logging.error(u'Unable to read database.')
+                return False
+
+            for i in data:
+                ranks[i['imdbid']] = (i['status'], i['rank'])
+
+        return ranks
+
+    def get_stored_guids(self, guids):
+        ''' Finds which guids are already in SEARCHRESULTS
+        guids: iterable of str guids to look for
+
+        Looks up every guid in as few queries as possible, 500 guids per query.
+
+        Returns set of tuples (imdbid, guid) for stored guids, or False on failure
+        '''
+
+        guids = list(set(guids))
+        stored = set()
+
+        for chunk in [guids[i:i + 500] for i in range(0, len(guids), 500)]:
+            command = u'SELECT imdbid, guid FROM SEARCHRESULTS WHERE guid IN ({})'.format(u', '.join(['?'] * len(chunk)))
+            data = self.execute([command, chunk])
+
+            if not data:
+                logging.error(u'Unable to read database.')
+                return False
+
+            for i in data:
+                stored.add((i['imdbid'], i['guid']))
+
+        return stored
+
+    def get_rss_checkpoints(self):
+        ''' Gets newest rss item seen from each indexer
+
+        Returns dict {indexer: guid}, or False on failure
+        '''
+
+        data = self.execute(u'SELECT indexer, guid FROM RSSCHECKPOINTS')
+
+        if not data:
+            logging.error(u'Unable to read database.')
+            return False
+
+        return {i['indexer']: i['guid'] for i in data}
+
+    def set_rss_checkpoints(self, checkpoints):
+        ''' Stores newest rss item seen from each indexer
+        checkpoints: dict {indexer: guid}
+
+        Replaces existing checkpoints of the same indexers.
+
+        Returns Bool
+        '''
+
+        if not checkpoints:
+            return True
+
+        updated = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(indexer, guid, updated) for indexer, guid in checkpoints.iteritems()]
+
+        if self.execute([u'INSERT OR REPLACE INTO RSSCHECKPOINTS (indexer, guid, updated) VALUES (?, ?, ?)', rows]):
+            return True
+        else:
+            logging.error(u'Unable to store rss checkpoints.')
+            return False
+
     def row_exists(self, TABLE, imdbid='', guid='', downloadid=''):
         ''' Checks if row exists in table
         :param TABLE: str name of sql table to look through
@@ -454,9 +1338,7 @@ class SQL(object):
         else:
             return 'ID ERROR'
 
-        command = u'SELECT 1 FROM {} WHERE {}="{}"'.format(TABLE, idcol, idval)
-
-        row = self.execute(command)
+        row = self.query(u'SELECT 1 FROM {table} WHERE {idcol}=? LIMIT 1', (idval,), table=TABLE, idcol=idcol)
 
         if row is False or row.fetchone() is None:
             return False
@@ -475,9 +1357,7 @@ class SQL(object):
 
         logging.info(u'Retreving search result details for {}.'.format(idval.split('&')[0]))
 
-        command = u'SELECT * FROM SEARCHRESULTS WHERE {}="{}"'.format(idcol, idval)
-
-        result = self.execute(command)
+        result = self.query(u'SELECT * FROM SEARCHRESULTS WHERE {idcol}=?', (idval,), idcol=idcol)
 
         if result:
             return result.fetchone()
@@ -509,92 +1389,349 @@ class SQL(object):
 
         return table_dict
 
-    def _get_intended_schema(self):
-        d = {}
-        for table in self.metadata.tables.keys():
-            selftable = getattr(self, table)
-            d2 = {}
-            for i in selftable.c:
-                d2[i.name] = str(i.type)
-            d[table] = d2
-        return d
+    def _get_existing_indexes(self):
+        ''' Gets names of all indexes in database
+
+        Returns list of str index names
+        '''
+
+        command = 'SELECT name FROM sqlite_master WHERE type="index"'
+        indexes = self.execute(command)
+
+        if not indexes:
+            return []
+
+        return [i[0] for i in indexes]
+
+    def update_indexes(self):
+        ''' Creates any missing indexes
+        Indexes are added in place, tables are not copied or rebuilt.
+
+        Returns Bool
+        '''
+
+        existing = self._get_existing_indexes()
+
+        for table in self.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                logging.info(u'Creating index {} on {}.'.format(index.name, table.name))
+                try:
+                    index.create(self.engine)
+                except Exception as e: # noqa
+                    logging.error(u'Unable to create index {}.'.format(index.name), exc_info=True)
+                    return False
+        return True
+
+    def get_user_version(self):
+        ''' Gets schema version stored in database
+
+        Databases created before versioning was added report 0.
+
+        Returns int
+        '''
+
+        result = self.execute(u'PRAGMA user_version')
+        if not result:
+            return 0
+        return result.fetchone()[0]
+
+    def set_user_version(self, version):
+        ''' Stores schema version in database
+        version: int schema version
+
+        Returns Bool
+        '''
+
+        logging.info(u'Setting database schema version to {}.'.format(version))
+        if self.execute(u'PRAGMA user_version = {}'.format(int(version))):
+            return True
+        else:
+            return False
 
     def update_tables(self):
+        ''' Brings database schema up to date
+        Compares PRAGMA user_version to self.schema_version. If they match there
+            is nothing to do and the existing schema is never inspected.
 
-        existing = self._get_existing_schema()
-        intended = self._get_intended_schema()
+        Otherwise runs every migration newer than the database's version, in order,
+            storing the new version after each one succeeds. An interrupted
+            update resumes from the last finished migration on next start.
 
-        diff = Comparisons.compare_dict(intended, existing)
+        Returns Bool
+        '''
 
-        if not diff:
+        version = self.get_user_version()
+
+        if version == self.schema_version:
+            return True
+        elif version > self.schema_version:
+            logging.warning(u'Database schema version {} is newer than expected version {}.'.format(version, self.schema_version))
             return True
 
         print 'Database update required. This may take some time.'
+        logging.info(u'Updating database from schema version {} to {}.'.format(version, self.schema_version))
 
-        backup_dir = os.path.join(core.PROG_PATH, 'db')
-        logging.info(u'Backing up database to {}.'.format(backup_dir))
-        print u'Backing up database to {}.'.format(backup_dir)
-        try:
-            if not os.path.isdir(backup_dir):
-                os.mkdir(backup_dir)
-            backup = u'{}.{}'.format(core.DB_FILE, datetime.date.today())
-            shutil.copyfile(core.DB_FILE, os.path.join(backup_dir, backup))
-        except Exception, e: # noqa
-            print 'Error backing up database.'
-            logging.error(u'Copying SQL DB.', exc_info=True)
-            raise
+        for migration_version, name in self.migrations:
+            if migration_version <= version:
+                continue
+
+            logging.info(u'Running database migration {}.'.format(migration_version))
+            print u'Running database migration {}.'.format(migration_version)
+
+            if getattr(self, name)() is False:
+                logging.error(u'Database migration {} failed.'.format(migration_version))
+                print u'Database migration {} failed.'.format(migration_version)
+                return False
 
-        logging.info(u'Modifying database tables.')
-        print 'Modifying tables.'
+            self.set_user_version(migration_version)
 
+        if not self.update_indexes():
+            return False
+
+        self.invalidate_movies()
+
+        logging.info(u'Database updated')
+        print 'Database updated.'
+        return True
+
+    def _backup_database(self):
+        ''' Writes snapshot of database to PROG_PATH/db
+
+        Only called by migrations that rebuild tables. Snapshots taken here are
+            labelled 'migration' so they are never rotated away.
+
+        Raises exception on failure
         '''
-        For each item in diff, create new column.
-        Then, if the new columns name is in self.convert_names, copy data from old column
-        Create the new table, then copy data from TMP table
+
+        print u'Backing up database to {}.'.format(os.path.join(core.PROG_PATH, 'db'))
+        if not dbbackup.Backup().snapshot(label=u'migration'):
+            print 'Error backing up database.'
+            raise Exception(u'Unable to back up database before migration.')
+
+    def _migrate_1(self):
+        ''' Converts unversioned databases to schema version 1
+
+        Creates missing tables and adds missing columns in place with ALTER TABLE,
+            copying data from renamed columns listed in convert_names.
+
+        Tables are only rebuilt, after backing up the database, if an existing
+            column's type differs from its version 1 definition.
+
+        Tables and columns are defined here rather than taken from the class
+            metadata so later schema changes are left to later migrations.
+
+        Returns Bool
         '''
-        for table, schema in diff.iteritems():
-            logging.info(u'Modifying table {}.'.format(table))
-            print u'Modifying table {}'.format(table)
-            for name, kind in schema.iteritems():
-                command = u'ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, kind)
 
+        # {TABLENAME: [(column, type)]}
+        intended = {'MOVIES': [('added_date', 'TEXT'),
+                               ('imdbid', 'TEXT'),
+                               ('title', 'TEXT'),
+                               ('year', 'TEXT'),
+                               ('poster', 'TEXT'),
+                               ('plot', 'TEXT'),
+                               ('url', 'TEXT'),
+                               ('score', 'TEXT'),
+                               ('release_date', 'TEXT'),
+                               ('rated', 'TEXT'),
+                               ('status', 'TEXT'),
+                               ('predb', 'TEXT'),
+                               ('quality', 'TEXT'),
+                               ('finished_date', 'TEXT'),
+                               ('finished_score', 'SMALLINT'),
+                               ('finished_file', 'TEXT'),
+                               ('backlog', 'SMALLINT'),
+                               ('tmdbid', 'TEXT'),
+                               ('alternative_titles', 'TEXT'),
+                               ('digital_release_date', 'TEXT')
+                               ],
+                    'SEARCHRESULTS': [('score', 'SMALLINT'),
+                                      ('size', 'SMALLINT'),
+                                      ('status', 'TEXT'),
+                                      ('pubdate', 'TEXT'),
+                                      ('title', 'TEXT'),
+                                      ('imdbid', 'TEXT'),
+                                      ('indexer', 'TEXT'),
+                                      ('date_found', 'TEXT'),
+                                      ('info_link', 'TEXT'),
+                                      ('guid', 'TEXT'),
+                                      ('torrentfile', 'TEXT'),
+                                      ('resolution', 'TEXT'),
+                                      ('type', 'TEXT'),
+                                      ('downloadid', 'TEXT'),
+                                      ('freeleech', 'SMALLINT')
+                                      ],
+                    'MARKEDRESULTS': [('imdbid', 'TEXT'),
+                                      ('guid', 'TEXT'),
+                                      ('status', 'TEXT')
+                                      ]
+                    }
+
+        # {TABLENAME: [(new_col, old_col), (new_col, old_col)]}
+        convert_names = {'MOVIES':
+                         [('url', 'tomatourl'),
+                          ('score', 'tomatorating'),
+                          ('release_date', 'released'),
+                          ('finished_date', 'finisheddate')
+                          ]}
+
+        existing = self._get_existing_schema()
+
+        if existing is False:
+            return False
+
+        rebuild = []
+
+        for table, columns in intended.iteritems():
+            if table not in existing:
+                logging.info(u'Creating new table {}.'.format(table))
+                print u'Creating new table {}'.format(table)
+                self._create_table(table, columns)
+                continue
+
+            for name, kind in columns:
+                if name in existing[table]:
+                    if existing[table][name] != kind and table not in rebuild:
+                        rebuild.append(table)
+                    continue
+
+                logging.info(u'Adding column {} to {}.'.format(name, table))
+                print u'Adding column {} to {}'.format(name, table)
+                command = u'ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, kind)
                 self.execute(command)
 
-                if table in self.convert_names.keys():
-                    for pair in self.convert_names[table]:
-                        if pair[0] == name:
-                            command = u'UPDATE {} SET {} = {}'.format(table, pair[0], pair[1])
-                            self.execute(command)
-
-            # move TABLE to TABLE_TMP
-            table_tmp = u'{}_TMP'.format(table)
-            logging.info(u'Renaming table to {}.'.format(table_tmp))
-            print u'Renaming table to {}'.format(table_tmp)
-            command = u'ALTER TABLE {} RENAME TO {}'.format(table, table_tmp)
-            self.execute(command)
+                for new, old in convert_names.get(table, []):
+                    if new == name and old in existing[table]:
+                        command = u'UPDATE {} SET {} = {}'.format(table, new, old)
+                        self.execute(command)
 
-            # create new table
-            logging.info(u'Creating new table {}.'.format(table))
-            print u'Creating new table {}'.format(table)
-            table_meta = getattr(self, table)
-            table_meta.create(self.engine)
-
-            # copy data over
-            logging.info(u'Merging data from {} to {}.'.format(table_tmp, table))
-            print u'Merging data from {} to {}'.format(table_tmp, table)
-            names = u', '.join(intended[table].keys())
-            command = u'INSERT INTO {} ({}) SELECT {} FROM {}'.format(table, names, names, table_tmp)
-            self.execute(command)
+        if rebuild:
+            self._backup_database()
+            for table in rebuild:
+                self._rebuild_table(table, intended[table])
 
-            logging.info(u'Dropping table {}.'.format(table_tmp))
-            print u'Dropping table {}'.format(table_tmp)
-            command = u'DROP TABLE {}'.format(table_tmp)
-            self.execute(command)
+        return True
 
-            logging.info(u'Finished updating table {}.'.format(table))
-            print u'Finished updating table {}'.format(table)
+    def _migrate_2(self):
+        ''' Adds INTEGER day number columns for every text date column
 
-        logging.info(u'Database updated')
-        print 'Database updated.'
+        Day columns are added if missing, then filled from their text columns.
+            Dates in '%Y-%m-%d' format are converted by sqlite, pubdate is
+            parsed row by row.
+
+        Returns Bool
+        '''
+
+        # {TABLENAME: [(date_col, day_col)]}
+        day_columns = {'MOVIES': [('added_date', 'added_day'),
+                                  ('release_date', 'release_day'),
+                                  ('finished_date', 'finished_day')
+                                  ],
+                       'SEARCHRESULTS': [('date_found', 'found_day'),
+                                         ('pubdate', 'pub_day')
+                                         ]
+                       }
+
+        existing = self._get_existing_schema()
+        if existing is False:
+            return False
+
+        with self.transaction():
+            for table, days in day_columns.iteritems():
+                for date_col, day_col in days:
+                    if day_col not in existing.get(table, {}):
+                        logging.info(u'Adding column {} to {}.'.format(day_col, table))
+                        print u'Adding column {} to {}'.format(day_col, table)
+                        command = u'ALTER TABLE {} ADD COLUMN {} INTEGER'.format(table, day_col)
+                        self.execute(command)
+
+                    if date_col == 'pubdate':
+                        continue
+                    logging.info(u'Converting {}.{} to {}.'.format(table, date_col, day_col))
+                    command = u'UPDATE {0} SET {1} = CAST(julianday({2}) - 2440587.5 AS INTEGER)'.format(table, day_col, date_col)
+                    self.execute(command)
+
+            logging.info(u'Converting SEARCHRESULTS.pubdate to pub_day.')
+            rows = self.execute(u'SELECT rowid, pubdate FROM SEARCHRESULTS WHERE pubdate IS NOT NULL').fetchall()
+            rows = [(self.day_number(pubdate), rowid) for rowid, pubdate in rows]
+            if rows:
+                self.execute([u'UPDATE SEARCHRESULTS SET pub_day=? WHERE rowid=?', rows])
+
+        return True
+
+    def _migrate_3(self):
+        ''' Adds RSSCHECKPOINTS table
+
+        Returns Bool
+        '''
+
+        logging.info(u'Creating new table RSSCHECKPOINTS.')
+        print u'Creating new table RSSCHECKPOINTS'
+        self._create_table('RSSCHECKPOINTS', [('indexer', 'TEXT'), ('guid', 'TEXT'), ('updated', 'TEXT')])
+        return True
+
+    def _create_table(self, table, columns):
+        ''' Creates table if it does not exist
+        table: str name of table
+        columns: list of tuples (str column name, str type)
+
+        Used by migrations, which define tables as they were at their schema
+            version. Indexes are added afterward by update_indexes.
+
+        Does not return
+        '''
+
+        command = u'CREATE TABLE IF NOT EXISTS {} ({})'.format(table, u', '.join(u'{} {}'.format(*i) for i in columns))
+        self.execute(command)
+
+    def _rebuild_table(self, table, columns):
+        ''' Recreates table with new column definitions
+        table: str name of table
+        columns: list of tuples (str column name, str type)
+
+        Renames table to TABLE_TMP, creates the new table, copies all data over,
+            then drops TABLE_TMP. Requires every column to exist in the old table.
+
+        Does not return
+        '''
+
+        logging.info(u'Modifying table {}.'.format(table))
+        print u'Modifying table {}'.format(table)
+
+        # indexes follow their table when renamed, drop them so update_indexes can recreate them
+        command = u'SELECT name FROM sqlite_master WHERE type="index" AND tbl_name=? AND sql IS NOT NULL'
+        indexes = self.execute([command, (table,)])
+        for index in (indexes.fetchall() if indexes else []):
+            command = u'DROP INDEX IF EXISTS {}'.format(index[0])
+            self.execute(command)
+
+        # move TABLE to TABLE_TMP
+        table_tmp = u'{}_TMP'.format(table)
+        logging.info(u'Renaming table to {}.'.format(table_tmp))
+        print u'Renaming table to {}'.format(table_tmp)
+        command = u'ALTER TABLE {} RENAME TO {}'.format(table, table_tmp)
+        self.execute(command)
+
+        # create new table
+        logging.info(u'Creating new table {}.'.format(table))
+        print u'Creating new table {}'.format(table)
+        self._create_table(table, columns)
+
+        # copy data over
+        logging.info(u'Merging data from {} to {}.'.format(table_tmp, table))
+        print u'Merging data from {} to {}'.format(table_tmp, table)
+        names = u', '.join(name for name, kind in columns)
+        command = u'INSERT INTO {} ({}) SELECT {} FROM {}'.format(table, names, names, table_tmp)
+        self.execute(command)
+
+        logging.info(u'Dropping table {}.'.format(table_tmp))
+        print u'Dropping table {}'.format(table_tmp)
+        command = u'DROP TABLE {}'.format(table_tmp)
+        self.execute(command)
+
+        logging.info(u'Finished updating table {}.'.format(table))
+        print u'Finished updating table {}'.format(table)
 
 # pylama:ignore=W0401
@@ -8,6 +8,12 @@ logging = logging.getLogger(__name__)
 
 class Status(object):
 
+    # {rank from SQL.get_result_ranks: movie status}
+    rank_status = {3: u'Finished',
+                   2: u'Snatched',
+                   1: u'Found'
+                   }
+
     def __init__(self):
         self.sql = sqldb.SQL()
         self.library = library.ImportDirectory()
@@ -141,34 +147,46 @@ class Status(object):
         Returns bool on success/failure.
         '''
 
-        local_details = self.sql.get_movie_details('imdbid', imdbid)
-        if local_details:
-            current_status = local_details.get('status')
-        else:
-            return True
+        return self.movie_statuses([imdbid])
 
-        if current_status == 'Disabled':
-            return True
+    def movie_statuses(self, imdbids=None):
+        ''' Updates status of many movies at once
+        :param imdbids: list of str imdb identification numbers <optional>
+
+        Ranks every movie's search results in one aggregate query, then writes
+            back only the movies whose status actually changed.
+
+        Status is set to the highest possible level:
+            Finished > Snatched > Found (any Available result) > Wanted
+
+        Disabled movies are never changed.
+
+        If imdbids is not supplied, updates every movie in the library.
+
+        Returns bool on success/failure.
+        '''
 
-        result_status = self.sql.get_distinct('SEARCHRESULTS', 'status', 'imdbid', imdbid)
-        if result_status is False:
-            logging.error(u'Could not get SEARCHRESULTS statuses for {}'.format(imdbid))
+        ranks = self.sql.get_result_ranks(imdbids)
+        if ranks is False:
+            logging.error(u'Could not get SEARCHRESULTS statuses.')
             return False
-        elif result_status is None:
-            status = u'Wanted'
-        else:
-            if 'Finished' in result_status:
-                status = u'Finished'
-            elif 'Snatched' in result_status:
-                status = u'Snatched'
-            elif 'Available' in result_status:
-                status = u'Found'
-            else:
-                status = u'Wanted'
 
-        logging.info(u'Setting MOVIES {} status to {}.'.format(imdbid, status))
-        if self.sql.update('MOVIES', 'status', status, 'imdbid', imdbid):
+        changed = []
+        for imdbid, (current_status, rank) in ranks.iteritems():
+            if current_status == 'Disabled':
+                continue
+
+            status = self.rank_status.get(rank, u'Wanted')
+
+            if status != current_status:
+                logging.info(u'Setting MOVIES {} status to {}.'.format(imdbid, status))
+                changed.append((status, imdbid))
+
+        if not changed:
+            return True
+
+        if self.sql.update_many('MOVIES', 'status', 'imdbid', changed):
             return True
         else:
-            logging.error(u'Could not set {} to {}'.format(imdbid, status))
+            logging.error(u'Could not update status of {} movies.'.format(len(changed)))
             return False
@@ -206,11 +206,31 @@ $(document).ready(function() {
         });
     });
 
+    $('div#search_results').on('click', 'li#more_results a', function(e){
+        var imdbid = $('span#title').attr('imdbid');
+        var quality = $('select#quality_profile').val();
+        var offset = $(this).attr('offset');
+        var $more = $(this).closest('li#more_results');
+
+        e.preventDefault();
+
+        // Appends only the next page to the list
+        $.post(url_base + "/ajax/refresh_list", {"list":'#result_list', 'imdbid':imdbid, "quality":quality, "offset":offset})
+        .done(function(html){
+            var $list = $('ul#result_list');
+            $more.remove();
+            $list.children('li.data').last().addClass('bbord');
+            $list.append($(html).children());
+        });
+    });
+
     function refresh_list(list, imdbid, quality){
         if(imdbid === undefined) {
             imdbid = '';
         };
 
+        var params = {"list":list, 'imdbid':imdbid, "quality":quality};
+
         var $list = $(list)
         cls_obj = $list.prop('classList');
 
@@ -220,7 +240,7 @@ $(document).ready(function() {
             classes = classes + v + ' '
         })
 
-        $.post(url_base + "/ajax/refresh_list", {"list":list, 'imdbid':imdbid, "quality":quality})
+        $.post(url_base + "/ajax/refresh_list", params)
         .done(function(html){
             var $parent = $list.parent()
             $list.remove();
@@ -6,6 +6,12 @@ from dominate.tags import *
 
 class MovieStatusPopup():
 
+    # Columns of SEARCHRESULTS shown in result_list
+    result_columns = ['type', 'info_link', 'title', 'guid', 'status', 'size', 'score', 'indexer', 'freeleech', 'pubdate']
+
+    # Number of results to show at once in result_list
+    page_size = 50
+
     def __init__(self):
         self.sql = sqldb.SQL()
 
@@ -21,7 +27,7 @@ class MovieStatusPopup():
 
         container = div(id='container')
         with container:
-            script(src=core.URL_BASE + '/static/js/status/movie_status_popup.js?v=03.15f')
+            script(src=core.URL_BASE + '/static/js/status/movie_status_popup.js?v=03.15h')
             if not data:
                 span(u'Unable to get movie information from database. Check logs for more information.')
                 return doc.render()
@@ -72,67 +78,107 @@ class MovieStatusPopup():
 
         return unicode(container)
 
-    def result_list(self, imdbid, quality):
-        results = self.sql.get_search_results(imdbid, quality)
+    def result_list(self, imdbid, quality, offset=0):
+        ''' Renders search results list
+        imdbid: str imdb id #
+        quality: str name of quality profile, used to determine sort order
+        offset: int number of results already shown <default 0>
 
-        # Filter out any results we don't want to show
-        if not core.CONFIG['Downloader']['Sources']['usenetenabled']:
-            results = [res for res in results if res['type'] != 'nzb']
-        if not core.CONFIG['Downloader']['Sources']['torrentenabled']:
-            results = [res for res in results if res['type'] not in ['torrent', 'magnet']]
+        Only the columns displayed are read from the database, self.page_size results
+            at a time. If there are more results a link to load the next page is added
+            to the end of the list.
+
+        With an offset only the next page is rendered, as a ul.result_page whose items
+            are appended to the existing list.
 
-        result_list = ul(id='result_list')
+        Returns str html
+        '''
+
+        # Filter out any results we don't want to show
+        types = ['import']
+        if core.CONFIG['Downloader']['Sources']['usenetenabled']:
+            types.append('nzb')
+        if core.CONFIG['Downloader']['Sources']['torrentenabled']:
+            types += ['torrent', 'magnet']
+
+        offset = int(offset)
+        results = self.sql.get_search_results_page(imdbid, quality, columns=self.result_columns, types=types, limit=self.page_size, offset=offset)
+
+        if offset:
+            result_list = ul(cls='result_page')
+        else:
+            result_list = ul(id='result_list')
         with result_list:
 
             if not results:
-                li(u'Nothing found yet.', cls='title bold')
-                li(u'Next automatic search scheduled for {}'.format(Conversions.human_datetime(core.NEXT_SEARCH)), cls='title')
+                if not offset:
+                    li(u'Nothing found yet.', cls='title bold')
+                    li(u'Next automatic search scheduled for {}'.format(Conversions.human_datetime(core.NEXT_SEARCH)), cls='title')
             else:
-                for idx, res in enumerate(results):
-                    kind = res['type']
-                    info_link = res['info_link']
-                    title = res['title']
-                    guid = res['guid']
-                    status = res['status']
-                    size = Conversions.human_file_size(res['size'])
-                    pubdate = res['pubdate']
-
-                    # applied bottom border to all but last element
-                    if idx == len(results) - 1:
-                        bbord = u''
-                    else:
-                        bbord = u'bbord'
-                    with li(cls='title bold'):
-                        span(title, cls='name', title=title)
-                        with span(cls='buttons'):
-                            with a(href=info_link, target='_blank'):
-                                i(cls='fa fa-info-circle')
-                            i(cls='fa fa-download', id='manual_download', kind=kind, guid=guid)
-                            i(cls='fa fa-ban', id='mark_bad', guid=guid)
-                    with li(cls='data ' + bbord):
-                        span(u'Type:')
-                        span(kind, cls='bold')
-                        span(u' Status:')
-                        if status == 'Snatched':
-                            span(status, cls='status_text bold snatched', guid=guid)
-                        elif status == 'Bad':
-                            span(status, cls='status_text bold bad', guid=guid)
-                        elif status == 'Finished':
-                            span(status, cls='status_text bold finished', guid=guid)
-                        else:
-                            span(status, cls='status_text bold', guid=guid)
-                        span(u' Size:')
-                        span(size, cls='bold')
-                        span(u' Score:')
-                        span(res['score'], cls='bold')
-                        span(u' Source:')
-                        with span(res.get('indexer', ''), cls='bold'):
-                            if res['freeleech'] == 1:
-                                span(cls='fa fa-asterisk', title='Freeleech')
-                        if pubdate:
-                            span(u' Published: ')
-                            span(pubdate, cls='bold')
+                self._result_items(results)
+
+                shown = offset + len(results)
+                total = self.sql.count_search_results(imdbid, types=types)
+                if total > shown:
+                    with li(cls='title', id='more_results'):
+                        span(u'Showing {} of {} results. '.format(shown, total))
+                        a(u'Show more.', href='#', offset=shown)
 
         return unicode(result_list)
 
+    def _result_items(self, results):
+        ''' Renders search results as list items
+        results: list of dicts of search results
+
+        Must be called inside a Dominate ul tag.
+
+        Does not return
+        '''
+
+        for idx, res in enumerate(results):
+            kind = res['type']
+            info_link = res['info_link']
+            title = res['title']
+            guid = res['guid']
+            status = res['status']
+            size = Conversions.human_file_size(res['size'])
+            pubdate = res['pubdate']
+
+            # applied bottom border to all but last element
+            if idx == len(results) - 1:
+                bbord = u''
+            else:
+                bbord = u'bbord'
+            with li(cls='title bold'):
+                span(title, cls='name', title=title)
+                with span(cls='buttons'):
+                    with a(href=info_link, target='_blank'):
+                        i(cls='fa fa-info-circle')
+                    i(cls='fa fa-download', id='manual_download', kind=kind, guid=guid)
+                    i(cls='fa fa-ban', id='mark_bad', guid=guid)
+            with li(cls='data ' + bbord):
+                span(u'Type:')
+                span(kind, cls='bold')
+                span(u' Status:')
+                if status == 'Snatched':
+                    span(status, cls='status_text bold snatched', guid=guid)
+                elif status == 'Bad':
+                    span(status, cls='status_text bold bad', guid=guid)
+                elif status == 'Finished':
+                    span(status, cls='status_text bold finished', guid=guid)
+                else:
+                    span(status, cls='status_text bold', guid=guid)
+                span(u' Size:')
+                span(size, cls='bold')
+                span(u' Score:')
+                span(res['score'], cls='bold')
+                span(u' Source:')
+                with span(res.get('indexer', ''), cls='bold'):
+                    if res['freeleech'] == 1:
+                        span(cls='fa fa-asterisk', title='Freeleech')
+                if pubdate:
+                    span(u' Published: ')
+                    span(pubdate, cls='bold')
+        return
+
 # pylama:ignore=W0401
@@ -4,6 +4,8 @@ import cherrypy
 import core
 import dominate
 from cherrypy import expose
+from core.helpers import CircuitBreaker
+from core.providers.torrent import Torrent
 from dominate.tags import *
 from header import Header
 from head import Head
@@ -23,7 +25,7 @@ def settings_page(page):
         with doc.head:
             meta(name='git_url', content=core.GIT_URL)
             Head.insert()
-            link(rel='stylesheet', href=core.URL_BASE + '/static/css/settings.css?v=03.20b')
+            link(rel='stylesheet', href=core.URL_BASE + '/static/css/settings.css?v=03.20c')
             link(rel='stylesheet', href=core.URL_BASE + '/static/css/{}settings.css?v=03.20b'.format(core.CONFIG['Server']['theme']))
             link(rel='stylesheet', href=core.URL_BASE + '/static/css/plugin_conf_popup.css?v=02.22')
             link(rel='stylesheet', href=core.URL_BASE + '/static/css/{}plugin_conf_popup.css?v=02.22'.format(core.CONFIG['Server']['theme']))
@@ -44,6 +46,21 @@ def settings_page(page):
     return page_template
 
 
+def indexer_health(url):
+    ''' Adds warning icon if indexer is being skipped
+    :param url: str url of indexer
+
+    Must be called inside a Dominate tag.
+
+    Does not return
+    '''
+
+    health = CircuitBreaker.get(url) if url else None
+    if health and health['state'] == 'open':
+        i(cls='fa fa-exclamation-triangle indexer_health',
+          title=u'Skipped after {} failed requests, retrying at {}. Last error: {}'.format(health['failures'], health['retry'], health['last_error']))
+
+
 class Settings():
 
     @expose
@@ -375,6 +392,7 @@ class Settings():
                             input(type='text', cls='newznab_api', value=c[c_s]['NewzNab'][n][1], placeholder=" Api Key")
                             i(cls='newznab_clear fa fa-trash-o')
                             i(cls='indexer_test fa fa-plug', type='newznab')
+                            indexer_health(c[c_s]['NewzNab'][n][0])
                     with li(cls='add_newznab_row'):
                         i(cls='fa fa-plus-square', id='add_newznab_row')
 
@@ -388,6 +406,7 @@ class Settings():
                             input(type='text', cls='torznab_api', value=v[1], placeholder=" Api Key")
                             i(cls='torznab_clear fa fa-trash-o')
                             i(cls='indexer_test fa fa-plug', type='torznab')
+                            indexer_health(v[0])
                     with li(cls='add_torznab_row'):
                         i(cls='fa fa-plus-square', id='add_torznab_row')
 
@@ -397,24 +416,31 @@ class Settings():
                     with li(cls='torrent_indexer', id='bitsnoop'):
                         i(cls='torrent_check fa fa-square-o checkbox', value=str(c[c_s]['Torrent']['bitsnoop']))
                         span('BitSnoop')
+                        indexer_health(Torrent.urls['bitsnoop'])
                     with li(cls='torrent_indexer', id='extratorrent'):
                         i(cls='torrent_check fa fa-square-o checkbox', value=str(c[c_s]['Torrent']['extratorrent']))
                         span('ExtraTorrent')
+                        indexer_health(Torrent.urls['extratorrent'])
                     with li(cls='torrent_indexer', id='limetorrents'):
                         i(cls='torrent_check fa fa-square-o checkbox', value=str(c[c_s]['Torrent']['limetorrents']))
                         span('LimeTorrents')
+                        indexer_health(Torrent.urls['limetorrents'])
                     with li(cls='torrent_indexer', id='rarbg'):
                         i(cls='torrent_check fa fa-square-o checkbox', value=str(c[c_s]['Torrent']['rarbg']))
                         span('Rarbg')
+                        indexer_health(Torrent.urls['rarbg'])
                     with li(cls='torrent_indexer', id='skytorrents'):
                         i(cls='torrent_check fa fa-square-o checkbox', value=str(c[c_s]['Torrent']['skytorrents']))
                         span('SkyTorrents')
+                        indexer_health(Torrent.urls['skytorrents'])
                     with li(cls='torrent_indexer', id='thepiratebay'):
                         i(cls='torrent_check fa fa-square-o checkbox', value=str(c[c_s]['Torrent']['thepiratebay']))
                         span('ThePirateBay')
+                        indexer_health(Torrent.urls['thepiratebay'])
                     with li(cls='torrent_indexer', id='torrentz2'):
                         i(cls='torrent_check fa fa-square-o checkbox', value=str(c[c_s]['Torrent']['torrentz2']))
                         span('Torrentz2')
+                        indexer_health(Torrent.urls['torrentz2'])
 
         with div(id='save', cat='providers'):
             i(cls='fa fa-save')
@@ -163,6 +163,8 @@ if __name__ == '__main__':
     scheduler.AutoUpdateInstall.create()
     scheduler.ImdbRssSync.create()
     scheduler.PopularMoviesSync.create()
+    scheduler.DatabaseBackup.create()
+    scheduler.DatabaseMaintenance.create()
     scheduler_plugin.plugin.subscribe()
 
     # If windows os and daemon selected, start systray